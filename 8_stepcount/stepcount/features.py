@@ -1,11 +1,18 @@
+import os
+import hashlib
+from collections import OrderedDict
+from fractions import Fraction
+from functools import lru_cache
 import numpy as np
 import scipy.stats as stats
 import scipy.signal as signal
+import scipy.fft
 from scipy.ndimage import median_filter
 import statsmodels.tsa.stattools as stattools
 
 
 MIN_WINDOW_SEC = 2  # seconds
+FEATURES_VERSION = 1  # bump when features change, to invalidate FeatureCache entries
 
 
 def extract_features(xyz, sample_rate=100):
@@ -166,23 +173,259 @@ def peaks_features(v, sample_rate):
     return feats
 
 
+def batch_extract_features(X, sample_rate=100, chunk_size=1000):
+    """ Batch version of extract_features. X is an array of windows of shape (n,N,3).
+
+    Returns a float32 array of shape (n, len(get_feature_names())). Rows of
+    windows with NaNs, or all rows if windows are too short, are NaN.
+    Windows are processed `chunk_size` at a time to bound memory.
+    """
+
+    names = get_feature_names()
+    feats_arr = np.full((len(X), len(names)), np.nan, dtype='float32')
+
+    if X.shape[1] <= MIN_WINDOW_SEC * sample_rate:
+        return feats_arr
+
+    idxs = np.flatnonzero(~np.isnan(X).any(axis=(1, 2)))
+
+    for i in range(0, len(idxs), chunk_size):
+        idxs_ = idxs[i:i + chunk_size]
+
+        V = np.linalg.norm(X[idxs_], axis=-1)
+        V = median_filter(V, size=(1, 5), mode='nearest')
+        V = V - 1  # detrend: "remove gravity"
+        V = np.clip(V, -2, 2)  # clip abnormaly high values
+
+        feats = {}
+        feats.update(batch_moments_features(V, sample_rate))
+        feats.update(batch_quantile_features(V, sample_rate))
+        feats.update(batch_autocorr_features(V, sample_rate))
+        feats.update(batch_spectral_features(V, sample_rate))
+        feats.update(batch_fft_features(V, sample_rate))
+        feats.update(batch_peaks_features(V, sample_rate))
+
+        feats_arr[idxs_] = np.column_stack([feats[name] for name in names])
+
+    return feats_arr
+
+
+def batch_moments_features(V, sample_rate=None):
+    """ Batch version of moments_features. V is an array of shape (n,N) """
+    avg = np.mean(V, axis=1)
+    std = np.std(V, axis=1)
+    whr = std > .01
+    skew = np.zeros_like(avg)
+    kurt = np.zeros_like(avg)
+    if whr.any():
+        skew[whr] = np.nan_to_num(stats.skew(V[whr], axis=1))
+        kurt[whr] = np.nan_to_num(stats.kurtosis(V[whr], axis=1))
+    feats = {
+        'avg': avg,
+        'std': std,
+        'skew': skew,
+        'kurt': kurt,
+    }
+    return feats
+
+
+def batch_quantile_features(V, sample_rate=None):
+    """ Batch version of quantile_features """
+    feats = {}
+    feats['min'], feats['q25'], feats['med'], feats['q75'], feats['max'] = np.quantile(V, (0, .25, .5, .75, 1), axis=1)
+    return feats
+
+
+def batch_autocorr_features(V, sample_rate):
+    """ Batch version of autocorr_features, with the ACF computed via FFT """
+
+    nlags = 2 * sample_rate
+    n = V.shape[1]
+    D = V - np.mean(V, axis=1, keepdims=True)
+    nfft = scipy.fft.next_fast_len(2 * n - 1)
+    F = scipy.fft.rfft(D, nfft, axis=1)
+    acov = scipy.fft.irfft(F.real**2 + F.imag**2, nfft, axis=1)[:, :nlags + 1] / n
+    with np.errstate(divide='ignore', invalid='ignore'):  # ignore invalid div warnings
+        U = np.nan_to_num(acov / acov[:, :1])
+
+    rows = np.arange(len(U))
+
+    max_loc = _first_peak_locs(U, prominence=.1)
+    acf_1st_max = np.where(max_loc >= 0, U[rows, max_loc], 0.0)
+    acf_1st_max_loc = np.where(max_loc >= 0, max_loc / sample_rate, 0.0)  # in secs
+
+    min_loc = _first_peak_locs(-U, prominence=.1)
+    acf_1st_min = np.where(min_loc >= 0, U[rows, min_loc], 0.0)
+    acf_1st_min_loc = np.where(min_loc >= 0, min_loc / sample_rate, 0.0)  # in secs
+
+    feats = {
+        'acf_1st_max': acf_1st_max,
+        'acf_1st_max_loc': acf_1st_max_loc,
+        'acf_1st_min': acf_1st_min,
+        'acf_1st_min_loc': acf_1st_min_loc,
+        # autocorr_features takes the len of the np.where tuple, which is always 1
+        'acf_zeros': np.ones(len(U)),
+    }
+
+    return feats
+
+
+def batch_spectral_features(V, sample_rate):
+    """ Batch version of spectral_features """
+
+    feats = {}
+
+    freqs, powers = signal.periodogram(V, fs=sample_rate, detrend='constant', scaling='density', axis=1)
+    powers /= (V.shape[1] / sample_rate)    # unit/sec
+
+    total = np.sum(powers, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        P = powers / total[:, None]
+        feats['pentropy'] = -np.sum(np.where(P > 0, P * np.log(P), 0), axis=1)
+    feats['power'] = total
+
+    # peaks: strict local maxima, or find_peaks for rows with plateaus
+    is_peak = np.zeros(powers.shape, dtype='bool')
+    is_peak[:, 1:-1] = (powers[:, 1:-1] > powers[:, :-2]) & (powers[:, 1:-1] > powers[:, 2:])
+    for i in np.flatnonzero((np.diff(powers, axis=1) == 0).any(axis=1)):
+        is_peak[i] = False
+        is_peak[i, signal.find_peaks(powers[i])[0]] = True
+
+    TOPN = 3
+    peak_powers = np.where(is_peak, powers, -np.inf)
+    top = np.argsort(peak_powers, axis=1, kind='stable')[:, ::-1][:, :TOPN]
+    top_powers = np.take_along_axis(peak_powers, top, axis=1)
+    has_peak = np.isfinite(top_powers)
+    top_freqs = np.where(has_peak, freqs[top], 0)
+    top_powers = np.where(has_peak, top_powers, 0)
+    for i in range(TOPN):
+        feats[f"f{i + 1}"] = top_freqs[:, i]
+    for i in range(TOPN):
+        feats[f"p{i + 1}"] = top_powers[:, i]
+
+    return feats
+
+
+def batch_fft_features(V, sample_rate, nfreqs=5):
+    """ Batch version of fft_features """
+
+    _, powers = signal.welch(
+        V, fs=sample_rate,
+        nperseg=sample_rate,
+        noverlap=sample_rate // 2,
+        detrend='constant',
+        scaling='density',
+        average='median',
+        axis=1,
+    )
+
+    feats = {f"fft{i}": powers[:, i] for i in range(nfreqs + 1)}
+
+    return feats
+
+
+def batch_peaks_features(V, sample_rate):
+    """ Batch version of peaks_features """
+
+    U = butterfilt(V, 5, fs=sample_rate, axis=1)  # lowpass 5Hz
+
+    npeaks = np.zeros(len(U))
+    avg_promin = np.zeros(len(U))
+    min_promin = np.zeros(len(U))
+    max_promin = np.zeros(len(U))
+    for i, u in enumerate(U):
+        _, peak_props = signal.find_peaks(u, distance=0.2 * sample_rate, prominence=0.25)
+        prominences = peak_props['prominences']
+        npeaks[i] = len(prominences)
+        if len(prominences) > 0:
+            avg_promin[i] = np.mean(prominences)
+            min_promin[i] = np.min(prominences)
+            max_promin[i] = np.max(prominences)
+
+    feats = {
+        'npeaks': npeaks / (V.shape[1] / sample_rate),  # peaks/sec
+        'peaks_avg_promin': avg_promin,
+        'peaks_min_promin': min_promin,
+        'peaks_max_promin': max_promin,
+    }
+
+    return feats
+
+
+def _first_peak_locs(U, prominence):
+    """ Location of the first peak of each row, or -1 if none """
+    return np.asarray([
+        next(iter(signal.find_peaks(u, prominence=prominence)[0]), -1)
+        for u in U
+    ], dtype='int')
+
+
 def butterfilt(x, cutoffs, fs, order=4, axis=0):
     """ Butterworth filter """
-    nyq = 0.5 * fs
+    sos = butter_sos(cutoffs, fs, order=order)
+    y = signal.sosfiltfilt(sos, x, axis=axis)
+    return y
+
+
+def butter_sos(cutoffs, fs, order=4):
+    """ Butterworth filter design (second-order sections), as used by butterfilt """
     if isinstance(cutoffs, tuple):
         hicut, lowcut = cutoffs
         if hicut > 0:
-            btype = 'bandpass'
-            Wn = (hicut / nyq, lowcut / nyq)
-        else:
-            btype = 'low'
-            Wn = lowcut / nyq
+            return _butter_sos(order, (hicut, lowcut), fs, 'bandpass').copy()
+        return _butter_sos(order, lowcut, fs, 'low').copy()
+    return _butter_sos(order, cutoffs, fs, 'low').copy()
+
+
+@lru_cache(maxsize=32)
+def _butter_sos(order, cutoff, fs, btype):
+    """ The design only depends on its parameters, so it is made once per
+    (order, cutoff, fs, btype). Callers get a copy as sosfilt needs it writable """
+    nyq = 0.5 * fs
+    if btype == 'bandpass':
+        Wn = (cutoff[0] / nyq, cutoff[1] / nyq)
     else:
-        btype = 'low'
-        Wn = cutoffs / nyq
-    sos = signal.butter(order, Wn, btype=btype, analog=False, output='sos')
-    y = signal.sosfiltfilt(sos, x, axis=axis)
-    return y
+        Wn = cutoff / nyq
+    return signal.butter(order, Wn, btype=btype, analog=False, output='sos')
+
+
+def resample_windows(X, fs_in, fs_out, chunk_size=1000, cache_dir=None):
+    """
+    Polyphase resampling (scipy.signal.resample_poly) of windows X of shape
+    (n, N, 3) from fs_in to fs_out, chunk_size windows at a time, in float32.
+    If cache_dir is given, the result is saved there keyed by a hash of X and
+    the rates, and later calls with the same data load it memory-mapped.
+    """
+
+    ratio = (Fraction(fs_out) / Fraction(fs_in)).limit_denominator(1000)
+    up, down = ratio.numerator, ratio.denominator
+    nout = int(np.ceil(X.shape[1] * up / down))
+
+    path = None
+    if cache_dir is not None:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{fs_in}:{fs_out}:{X.dtype.str}:{X.shape}".encode())
+        for i in range(0, len(X), chunk_size):
+            h.update(np.ascontiguousarray(X[i:i + chunk_size]))
+        path = os.path.join(cache_dir, f"resampled-{h.hexdigest()}.npy")
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        Xr = np.lib.format.open_memmap(tmp, mode='w+', dtype='float32', shape=(len(X), nout) + X.shape[2:])
+    else:
+        Xr = np.empty((len(X), nout) + X.shape[2:], dtype='float32')
+
+    for i in range(0, len(X), chunk_size):
+        Xr[i:i + chunk_size] = signal.resample_poly(X[i:i + chunk_size], up, down, axis=1)
+
+    if path is not None:
+        Xr.flush()
+        del Xr
+        os.replace(tmp, path)
+        return np.load(path, mmap_mode='r')
+
+    return Xr
 
 
 def get_feature_names():
@@ -190,3 +433,108 @@ def get_feature_names():
 
     feats = extract_features(np.zeros((500, 3)), 100)
     return list(feats.keys())
+
+
+class FeatureCache:
+    """
+    On-disk cache of extracted features, keyed by a hash of the window
+    bytes, the sample rate and FEATURES_VERSION, so that the features of a
+    dataset are extracted once across runs and processes (e.g. when
+    refitting with other hyperparameters). Each put() writes one shard
+    (<name>.keys.npy and <name>.feats.npy), read back as memmaps, rather
+    than one file per window. The shards are indexed when a lookup misses,
+    and only the most recently indexed ones, up to `maxsize` windows, are
+    kept in the index.
+    """
+
+    def __init__(self, cache_dir, maxsize=1_000_000):
+        self.cache_dir = cache_dir
+        self.maxsize = maxsize
+        self._index = {}  # key -> (shard name, row)
+        self._shards = OrderedDict()  # shard name -> (keys, memmapped features), oldest first
+        self._seen = set()  # shard names indexed so far, including dropped ones
+
+    def keys(self, X, sample_rate):
+        """ Hash keys of an array of windows """
+        X = np.ascontiguousarray(X)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{FEATURES_VERSION}:{sample_rate}:{X.dtype.str}:{X.shape[1:]}".encode())
+        keys = []
+        for x in X:
+            h_ = h.copy()
+            h_.update(x)
+            keys.append(h_.hexdigest())
+        return keys
+
+    def get(self, keys, nfeats):
+        """ Return an array of cached features (NaN where missing) and the missing mask """
+        feats = np.full((len(keys), nfeats), np.nan, dtype='float32')
+        missing = np.ones(len(keys), dtype='bool')
+        locs = [self._index.get(key) for key in keys]
+        if any(loc is None for loc in locs):
+            self._refresh_index()
+            locs = [self._index.get(key) for key in keys]
+        for i, loc in enumerate(locs):
+            if loc is None:
+                continue
+            name, row = loc
+            f = self._shards[name][1][row]
+            if len(f) == nfeats:
+                feats[i] = f
+                missing[i] = False
+        return feats, missing
+
+    def put(self, keys, feats):
+        if len(keys) > 0:
+            self._save(keys, feats)
+
+    def _refresh_index(self):
+        """ Index the shards written since the last call, by any process """
+        try:
+            fnames = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for fname in fnames:
+            if not fname.endswith('.keys.npy'):
+                continue
+            name = fname[:-len('.keys.npy')]
+            if name in self._seen:
+                continue
+            try:
+                keys = np.load(os.path.join(self.cache_dir, fname)).astype('str').tolist()
+                feats = np.load(os.path.join(self.cache_dir, f"{name}.feats.npy"), mmap_mode='r')
+            except (OSError, ValueError):
+                continue
+            self._seen.add(name)
+            self._shards[name] = (keys, feats)
+            for row, key in enumerate(keys):
+                self._index[key] = (name, row)
+        # drop the oldest shards, but always keep the newest one
+        while len(self._index) > self.maxsize and len(self._shards) > 1:
+            name, (keys, _) = self._shards.popitem(last=False)
+            for key in keys:
+                if self._index.get(key, (None,))[0] == name:
+                    del self._index[key]
+
+    def _save(self, keys, feats):
+        # shards are named after their keys, so concurrent writes of the same
+        # batch are harmless; the keys file is written last to mark completion
+        os.makedirs(self.cache_dir, exist_ok=True)
+        keys = np.asarray(keys, dtype='S32')
+        name = hashlib.blake2b(keys.tobytes(), digest_size=16).hexdigest()
+        for suffix, arr in (('feats', np.asarray(feats, dtype='float32')), ('keys', keys)):
+            path = os.path.join(self.cache_dir, f"{name}.{suffix}.npy")
+            tmp = os.path.join(self.cache_dir, f"{name}.{suffix}.{os.getpid()}.tmp.npy")
+            np.save(tmp, arr)
+            os.replace(tmp, path)
+
+
+_feature_caches = {}
+
+
+def get_feature_cache(cache_dir):
+    """ Process-level FeatureCache, one per cache_dir, so that shards are
+    indexed once per process """
+    if cache_dir not in _feature_caches:
+        _feature_caches[cache_dir] = FeatureCache(cache_dir=cache_dir)
+    return _feature_caches[cache_dir]
@@ -1,4 +1,5 @@
 import numpy as np
+from stepcount import kernels
 
 
 class HMMSmoother():
@@ -36,6 +37,8 @@ class HMMSmoother():
         return self
 
     def predict(self, Y, groups=None):
+        """ Smooth a sequence of predicted labels, or of (n, nclasses)
+        predicted probabilities, with the fitted HMM """
         return self.viterbi(Y, groups)
 
     def viterbi(self, Y, groups=None):
@@ -45,15 +48,80 @@ class HMMSmoother():
             'transition': self.transmat,
             'labels': self.labels,
         }
-        if groups is None:
-            Y_vit = viterbi(Y, params)
-        else:
-            Y_vit = np.concatenate([
-                viterbi(Y[groups == g], params)
-                for g in ordered_unique(groups)
-            ])
+        Y_vit = viterbi(Y, params, groups)
         return Y_vit
 
+    def predict_proba(self, Y, groups=None):
+        """ Posterior probabilities (n, nlabels) of each label, columns
+        ordered as self.labels """
+        params = {
+            'prior': self.startprob,
+            'emission': self.emissionprob,
+            'transition': self.transmat,
+            'labels': self.labels,
+        }
+        return forward_backward(Y, params, groups)
+
+
+class OnlineHMMSmoother():
+    """
+    Fixed-lag Viterbi smoothing of a stream of observations, with the
+    parameters of a fitted HMMSmoother. Observations (labels or class
+    probabilities, as in HMMSmoother.predict) are passed in chunks to
+    update(), which returns the decisions for the observations that are now
+    `lag` steps behind the latest one. Only the best path of the last `lag`
+    steps ending in each label is kept, so memory is O(lag * nlabels). The
+    output approaches the offline Viterbi path as the lag grows. Call
+    flush() at the end of the stream to get the remaining decisions.
+    """
+
+    def __init__(self, hmms, lag=10):
+        self.params = {
+            'prior': hmms.startprob,
+            'emission': hmms.emissionprob,
+            'transition': hmms.transmat,
+            'labels': hmms.labels,
+        }
+        self.lag = lag
+        self.log_prior = _log(hmms.startprob)
+        self.log_transition = _log(hmms.transmat)  # (from, to)
+        self.reset()
+
+    def reset(self):
+        self.probs = None
+        # survivors[i]: last states of the best path ending in state i
+        self.survivors = None
+
+    def update(self, Y):
+        nlabels = len(self.log_prior)
+        states = np.arange(nlabels)
+        log_emission = _log_emission(np.asarray(Y), self.params)
+
+        decisions = []
+        for e in log_emission:
+            if self.probs is None:
+                self.probs = self.log_prior + e
+                self.survivors = states[:, None]
+            else:
+                scores = self.log_transition + self.probs[:, None]  # probs already in log scale
+                backpointers = np.argmax(scores, axis=0)
+                self.probs = e + scores[backpointers, states]
+                self.probs -= np.max(self.probs)  # keep in range, argmaxes unchanged
+                self.survivors = np.column_stack([self.survivors[backpointers], states])
+
+            if self.survivors.shape[1] > self.lag:
+                decisions.append(self.survivors[np.argmax(self.probs), 0])
+                self.survivors = self.survivors[:, 1:]
+
+        return self.params['labels'][np.asarray(decisions, dtype='int')]
+
+    def flush(self):
+        if self.probs is None:
+            return self.params['labels'][:0]
+        decisions = self.survivors[np.argmax(self.probs)]
+        self.reset()
+        return self.params['labels'][decisions]
+
 
 def compute_transition(Y, labels=None, groups=None):
     """ Compute transition matrix from sequence """
@@ -61,20 +129,23 @@ def compute_transition(Y, labels=None, groups=None):
     if labels is None:
         labels = np.unique(Y)
 
-    def _compute_transition(Y):
-        transition = np.vstack([
-            np.sum(Y[1:][(Y == label)[:-1]].reshape(-1, 1) == labels, axis=0)
-            for label in labels
-        ])
-        return transition
+    nlabels = len(labels)
+    codes, valid = label_codes(Y, labels)
 
     if groups is None:
-        transition = _compute_transition(Y)
+        same_group = np.ones(len(Y) - 1, dtype='bool')
     else:
-        transition = sum((
-            _compute_transition(Y[groups == g])
-            for g in ordered_unique(groups)
-        ))
+        # arrange by group, transitions only within groups
+        order, lengths = group_segments(groups)
+        codes, valid = codes[order], valid[order]
+        same_group = np.ones(len(Y) - 1, dtype='bool')
+        same_group[np.cumsum(lengths)[:-1] - 1] = False
+
+    whr = same_group & valid[:-1] & valid[1:]
+    transition = np.bincount(
+        codes[:-1][whr] * nlabels + codes[1:][whr],
+        minlength=nlabels * nlabels
+    ).reshape(nlabels, nlabels)
 
     transition = transition / np.sum(transition, axis=1).reshape(-1, 1)
 
@@ -87,15 +158,24 @@ def compute_emission(Y_pred, Y_true, labels=None):
     if labels is None:
         labels = np.unique(Y_true)
 
+    nlabels = len(labels)
+    codes_true, valid = label_codes(Y_true, labels)
+    codes_true = codes_true[valid]
+    Y_pred = Y_pred[valid]
+
     if Y_pred.ndim == 1:
-        Y_pred = np.hstack([
-            (Y_pred == label).astype('float')[:, None]
-            for label in labels
+        codes_pred, valid_pred = label_codes(Y_pred, labels)
+        emission = np.bincount(
+            codes_true[valid_pred] * nlabels + codes_pred[valid_pred],
+            minlength=nlabels * nlabels
+        ).reshape(nlabels, nlabels).astype('float')
+    else:
+        emission = np.column_stack([
+            np.bincount(codes_true, weights=y, minlength=nlabels)
+            for y in Y_pred.T
         ])
 
-    emission = np.vstack(
-        [np.mean(Y_pred[Y_true == label], axis=0) for label in labels]
-    )
+    emission = emission / np.bincount(codes_true, minlength=nlabels).reshape(-1, 1)
 
     return emission
 
@@ -117,43 +197,212 @@ def compute_prior(Y_true, labels=None, uniform=True):
     return prior
 
 
-def viterbi(Y, hmm_params):
-    ''' https://en.wikipedia.org/wiki/Viterbi_algorithm '''
+def viterbi(Y, hmm_params, groups=None):
+    ''' https://en.wikipedia.org/wiki/Viterbi_algorithm
 
-    def log(x):
-        SMALL_NUMBER = 1e-16
-        return np.log(x + SMALL_NUMBER)
+    Y is either a sequence of observed labels, or an (n, nclasses) array of
+    class probabilities (soft evidence), in which case the likelihood of
+    each hidden state is Y @ emission.T.
+
+    If groups is given, each group is decoded as a separate sequence and the
+    paths are concatenated in order of first appearance of the groups. All
+    sequences are decoded together in one batched recursion.
+    '''
 
-    prior = hmm_params['prior']
-    emission = hmm_params['emission']
-    transition = hmm_params['transition']
     labels = hmm_params['labels']
 
-    nobs = len(Y)
-    nlabels = len(labels)
+    # precompute log-parameters
+    log_prior = _log(hmm_params['prior'])
+    log_transition = _log(hmm_params['transition'])  # (from, to)
+    log_emission = _log_emission(Y, hmm_params)  # (nobs, nlabels)
 
-    Y = np.where(Y.reshape(-1, 1) == labels)[1]  # to numeric
-
-    probs = np.zeros((nobs, nlabels))
-    probs[0, :] = log(prior) + log(emission[:, Y[0]])
-    for j in range(1, nobs):
-        for i in range(nlabels):
-            probs[j, i] = np.max(
-                log(emission[i, Y[j]]) +
-                log(transition[:, i]) +
-                probs[j - 1, :])  # probs already in log scale
-    viterbi_path = np.zeros_like(Y)
-    viterbi_path[-1] = np.argmax(probs[-1, :])
-    for j in reversed(range(nobs - 1)):
-        viterbi_path[j] = np.argmax(
-            log(transition[:, viterbi_path[j + 1]]) +
-            probs[j, :])  # probs already in log scale
+    if groups is None:
+        lengths = np.asarray([len(Y)])
+    else:
+        order, lengths = group_segments(groups)
+        log_emission = log_emission[order]
+
+    if kernels.HAS_NUMBA:
+        viterbi_path = kernels.viterbi(log_prior, log_emission, log_transition, lengths)
+    else:
+        viterbi_path = _viterbi(log_prior, log_emission, log_transition, lengths)
 
     viterbi_path = labels[viterbi_path]  # to labels
 
     return viterbi_path
 
 
+def forward_backward(Y, hmm_params, groups=None):
+    ''' https://en.wikipedia.org/wiki/Forward%E2%80%93backward_algorithm
+
+    Posterior probabilities (n, nlabels) of each hidden state, with columns
+    ordered as hmm_params['labels']. Y and groups are as in viterbi, and
+    rows are in the same order as the viterbi output.
+    '''
+
+    log_emission = _log_emission(Y, hmm_params)  # (nobs, nlabels)
+
+    if groups is None:
+        lengths = np.asarray([len(Y)])
+    else:
+        order, lengths = group_segments(groups)
+        log_emission = log_emission[order]
+
+    # scaled likelihoods, the constant factor per observation cancels out
+    # with the normalization at each step
+    emission = np.exp(log_emission - np.max(log_emission, axis=1, keepdims=True))
+
+    posteriors = _by_length_bucket(
+        _forward_backward_batch, emission, lengths, hmm_params['prior'], hmm_params['transition']
+    )
+
+    return posteriors
+
+
+def _log(x):
+    SMALL_NUMBER = 1e-16
+    return np.log(x + SMALL_NUMBER)
+
+
+def _log_emission(Y, hmm_params):
+    """ Log-likelihood (nobs, nlabels) of each observation under each hidden state """
+    emission = hmm_params['emission']
+    if Y.ndim == 2:
+        return _log(Y @ emission.T)
+    labels = hmm_params['labels']
+    codes, valid = label_codes(Y, labels)  # to numeric
+    if not valid.all():
+        raise ValueError(f"Unknown labels {np.unique(Y[~valid])}, expected one of {labels}")
+    return _log(emission)[:, codes].T
+
+
+def _viterbi(log_prior, log_emission, log_transition, lengths):
+    """ Batched Viterbi recursion in log scale. log_emission (nobs, nlabels)
+    holds consecutive sequences of the given lengths. Returns the
+    concatenated paths. """
+    return _by_length_bucket(_viterbi_batch, log_emission, lengths, log_prior, log_transition)
+
+
+def _viterbi_batch(log_emission, lengths, log_prior, log_transition):
+    obs, lengths, nrunning, unpad = _pad_sequences(log_emission, lengths)
+    nseqs, max_len, nlabels = obs.shape
+
+    probs = log_prior + obs[:, 0]  # probs already in log scale
+    backpointers = np.zeros((nseqs, max_len, nlabels), dtype=np.min_scalar_type(nlabels))
+    for j in range(1, max_len):
+        m = nrunning[j + 1]  # sequences with an observation at step j
+        scores = log_transition + probs[:m, :, None]  # (m, from, to)
+        bp = np.argmax(scores, axis=1)
+        backpointers[:m, j] = bp
+        probs[:m] = obs[:m, j] + np.take_along_axis(scores, bp[:, None], axis=1)[:, 0]
+
+    path = np.zeros((nseqs, max_len), dtype='int')
+    path[np.arange(nseqs), lengths - 1] = np.argmax(probs, axis=1)
+    for j in reversed(range(max_len - 1)):
+        m = nrunning[j + 2]  # sequences continuing after step j
+        path[:m, j] = backpointers[np.arange(m), j + 1, path[:m, j + 1]]
+
+    return unpad(path)
+
+
+def _forward_backward_batch(emission, lengths, prior, transition):
+    """ Batched forward-backward with per-step normalization (scaling).
+    emission (nobs, nlabels) holds the likelihoods of consecutive sequences
+    of the given lengths. Returns the concatenated posteriors. """
+
+    obs, lengths, nrunning, unpad = _pad_sequences(emission, lengths)
+    nseqs, max_len, nlabels = obs.shape
+
+    def normalize(x):
+        return x / np.sum(x, axis=-1, keepdims=True)
+
+    alpha = np.zeros_like(obs)
+    alpha[:, 0] = normalize(prior * obs[:, 0])
+    for j in range(1, max_len):
+        m = nrunning[j + 1]  # sequences with an observation at step j
+        alpha[:m, j] = normalize((alpha[:m, j - 1] @ transition) * obs[:m, j])
+
+    beta = np.ones_like(obs)
+    for j in reversed(range(max_len - 1)):
+        m = nrunning[j + 2]  # sequences continuing after step j
+        beta[:m, j] = normalize((obs[:m, j + 1] * beta[:m, j + 1]) @ transition.T)
+
+    posteriors = normalize(unpad(alpha * beta))
+
+    return posteriors
+
+
+def _by_length_bucket(fn, X, lengths, *args):
+    """ fn(X_, lengths_, *args) on the consecutive sequences of X, batched by
+    length within a factor of 2, so that padding (see _pad_sequences) at
+    most doubles the memory when a few sequences are much longer than the
+    others. Returns the outputs of fn in the order of X. """
+
+    lengths = np.asarray(lengths)
+    bucket = np.ceil(np.log2(np.maximum(lengths, 1))).astype('int')
+    if np.all(bucket == bucket[0]):
+        return fn(X, lengths, *args)
+
+    bucket_of_obs = np.repeat(bucket, lengths)
+    out = None
+    for b in np.unique(bucket):
+        whr = bucket_of_obs == b
+        out_b = fn(X[whr], lengths[bucket == b], *args)
+        if out is None:
+            out = np.empty((len(X),) + out_b.shape[1:], dtype=out_b.dtype)
+        out[whr] = out_b
+    return out
+
+
+def _pad_sequences(X, lengths):
+    """ Pad consecutive sequences of X into a (nseqs, max_len, ...) array,
+    longest first so that the sequences still running at step j are always
+    a prefix of the batch. Returns the padded array, the sorted lengths, the
+    number of sequences of length >= j for each j, and a function to undo
+    the padding of arrays shaped (nseqs, max_len, ...). """
+
+    seq_order = np.argsort(-lengths, kind='stable')
+    lengths = lengths[seq_order]
+    max_len = lengths[0]
+    nrunning = np.searchsorted(-lengths, -np.arange(max_len + 1), side='right')
+
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    seq_starts = np.r_[0, np.cumsum(lengths[np.argsort(seq_order)])[:-1]][seq_order]
+    seq = np.repeat(np.arange(len(lengths)), lengths)
+    pos = np.arange(len(seq)) - np.repeat(starts, lengths)
+    idxs = np.repeat(seq_starts, lengths) + pos
+
+    padded = np.zeros((len(lengths), max_len) + X.shape[1:], dtype=X.dtype)
+    padded[seq, pos] = X[idxs]
+
+    def unpad(Z):
+        out = np.zeros((len(seq),) + Z.shape[2:], dtype=Z.dtype)
+        out[idxs] = Z[seq, pos]
+        return out
+
+    return padded, lengths, nrunning, unpad
+
+
+def label_codes(Y, labels):
+    """ Index of each element of Y in labels, and mask of the elements found """
+    sorter = np.argsort(labels)
+    idxs = np.searchsorted(labels, Y, sorter=sorter).clip(0, len(labels) - 1)
+    codes = sorter[idxs]
+    valid = labels[codes] == Y
+    return codes, valid
+
+
+def group_segments(groups):
+    """ Sort by group once. Returns the indices that arrange the data in
+    contiguous groups (ordered by first appearance, stable within groups)
+    and the length of each group. """
+    _, first_idxs, inverse = np.unique(groups, return_index=True, return_inverse=True)
+    rank = np.argsort(np.argsort(first_idxs))[inverse.reshape(-1)]
+    order = np.argsort(rank, kind='stable')
+    lengths = np.diff(np.flatnonzero(np.r_[True, np.diff(rank[order]) != 0, True]))
+    return order, lengths
+
+
 def ordered_unique(x):
     """ np.unique without sorting """
     return x[np.sort(np.unique(x, return_index=True)[1])]
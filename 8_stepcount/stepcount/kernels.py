@@ -0,0 +1,140 @@
+""" Optional compiled kernels, used when numba is installed """
+
+import numpy as np
+
+try:
+    import numba
+    from numba import prange
+except ImportError:
+    numba = None
+    prange = range
+
+HAS_NUMBA = numba is not None
+
+
+def viterbi(log_prior, log_emission, log_transition, lengths):
+    """ Viterbi paths of consecutive sequences of the given lengths,
+    same as hmm_utils._viterbi """
+    return _viterbi(
+        np.ascontiguousarray(log_prior, dtype='f8'),
+        np.ascontiguousarray(log_emission, dtype='f8'),
+        np.ascontiguousarray(log_transition, dtype='f8'),
+        np.asarray(lengths, dtype='int64'),
+    )
+
+
+def count_peaks(V, distance, prominence):
+    """ Number of peaks in each row of V, same as
+    len(scipy.signal.find_peaks(v, distance=distance, prominence=prominence)[0])
+    except for ties: for the distance filter, equally high peaks are ranked
+    by position (the last one first), while find_peaks uses the unstable
+    np.argsort, whose order of ties depends on the numpy build. Rows with
+    equally high peaks closer than distance can get different counts. """
+    if distance < 1:
+        raise ValueError('`distance` must be greater or equal to 1')
+    return _count_peaks(np.ascontiguousarray(V, dtype='f8'), float(distance), float(prominence))
+
+
+def _viterbi(log_prior, log_emission, log_transition, lengths):
+    nlabels = log_emission.shape[1]
+    path = np.zeros(log_emission.shape[0], dtype=np.int64)
+    probs = np.empty(nlabels)
+    new_probs = np.empty(nlabels)
+    backpointers = np.zeros((np.max(lengths), nlabels), dtype=np.int64)
+
+    start = 0
+    for n in lengths:
+        for i in range(nlabels):
+            probs[i] = log_prior[i] + log_emission[start, i]
+        for j in range(1, n):
+            for i in range(nlabels):
+                best_prev = -np.inf
+                best_k = 0
+                for k in range(nlabels):
+                    # same order of additions, and nan handling, as np.argmax
+                    q = log_transition[k, i] + probs[k]
+                    if np.isnan(best_prev):
+                        continue
+                    if q > best_prev or np.isnan(q):
+                        best_prev = q
+                        best_k = k
+                new_probs[i] = log_emission[start + j, i] + best_prev
+                backpointers[j, i] = best_k
+            probs[:] = new_probs
+        path[start + n - 1] = np.argmax(probs)
+        for j in range(n - 2, -1, -1):
+            path[start + j] = backpointers[j + 1, path[start + j + 1]]
+        start += n
+
+    return path
+
+
+def _count_peaks(V, distance, prominence):
+    nrows, n = V.shape
+    distance = np.ceil(distance)
+    counts = np.zeros(nrows, dtype=np.int64)
+
+    for r in prange(nrows):
+        x = V[r]
+
+        # local maxima, with the midpoint of flat peaks
+        peaks = np.empty(n // 2 + 1, dtype=np.int64)
+        npeaks = 0
+        i = 1
+        while i < n - 1:
+            if x[i - 1] < x[i]:
+                i_ahead = i + 1
+                while i_ahead < n - 1 and x[i_ahead] == x[i]:
+                    i_ahead += 1
+                if x[i_ahead] < x[i]:
+                    peaks[npeaks] = (i + i_ahead - 1) // 2
+                    npeaks += 1
+                    i = i_ahead
+            i += 1
+        peaks = peaks[:npeaks]
+
+        # distance: keep highest peaks first, drop their close neighbours
+        # (equally high peaks are ranked stably, the last one first)
+        keep = np.ones(npeaks, dtype=np.bool_)
+        priority = np.argsort(x[peaks], kind='mergesort')
+        for ii in range(npeaks - 1, -1, -1):
+            j = priority[ii]
+            if not keep[j]:
+                continue
+            k = j - 1
+            while 0 <= k and peaks[j] - peaks[k] < distance:
+                keep[k] = False
+                k -= 1
+            k = j + 1
+            while k < npeaks and peaks[k] - peaks[j] < distance:
+                keep[k] = False
+                k += 1
+
+        # prominence
+        count = 0
+        for j in range(npeaks):
+            if not keep[j]:
+                continue
+            peak = peaks[j]
+            left_min = x[peak]
+            i = peak
+            while 0 <= i and x[i] <= x[peak]:
+                if x[i] < left_min:
+                    left_min = x[i]
+                i -= 1
+            right_min = x[peak]
+            i = peak
+            while i < n and x[i] <= x[peak]:
+                if x[i] < right_min:
+                    right_min = x[i]
+                i += 1
+            if x[peak] - max(left_min, right_min) >= prominence:
+                count += 1
+        counts[r] = count
+
+    return counts
+
+
+if HAS_NUMBA:
+    _viterbi = numba.njit(cache=True)(_viterbi)
+    _count_peaks = numba.njit(cache=True, parallel=True)(_count_peaks)
@@ -1,19 +1,23 @@
-from copy import deepcopy
-from collections import defaultdict, Counter
+import os
+import json
+from copy import copy, deepcopy
+from collections import Counter
 import torch
 import numpy as np
 import pandas as pd
-from scipy.signal import find_peaks
+from scipy.signal import find_peaks, peak_prominences, sosfiltfilt
 from scipy.optimize import minimize
 from scipy.special import softmax
-from scipy import stats
+import joblib
 from joblib import Parallel, delayed
 from sklearn import metrics
+from sklearn.base import clone
 from sklearn.model_selection import GroupShuffleSplit
 from imblearn.ensemble import BalancedRandomForestClassifier
 from stepcount import hmm_utils
 from stepcount import features
 from stepcount import sslmodel
+from stepcount import kernels
 from tqdm.auto import tqdm
 from torch.utils.data import DataLoader
 
@@ -30,6 +34,9 @@ class StepCounter:
         cv=5,
         wd_type='ssl',
         wd_params=None,
+        optimizer='nelder-mead',
+        input_sample_rate=None,
+        resample_cache_dir=None,
         n_jobs=-1,
         verbose=False
     ):
@@ -39,6 +46,7 @@ class StepCounter:
         self.pnr = pnr
         self.lowpass_hz = lowpass_hz
         self.cv = cv
+        self.optimizer = optimizer
         self.n_jobs = n_jobs
         self.verbose = verbose
 
@@ -74,11 +82,26 @@ class StepCounter:
         self.wd = wd(**self.wd_params)
 
         self.window_len = int(np.ceil(self.window_sec * self.sample_rate))
+
+        # rate of the data passed in, if different from the model's (e.g. raw
+        # 100Hz data in ssl mode): windows are then resampled to sample_rate
+        self.input_sample_rate = input_sample_rate or self.sample_rate
+        self.input_window_len = int(np.ceil(self.window_sec * self.input_sample_rate))
+        self.resample_cache_dir = resample_cache_dir
+
         self.find_peaks_params = None
+        self.tuning_surface = None
         self.cv_scores = None
+        self.cv_results = None
 
     def fit(self, X, Y, groups=None):
 
+        # checked before the (long) cross-validation
+        if self.optimizer not in ('grid', 'nelder-mead'):
+            raise ValueError(f"Unrecognized {self.optimizer=}")
+
+        X = self.resample(X)
+
         # define walk/non-walk based on threshold
         W = np.zeros_like(Y)
         W[Y >= self.steptol] = 1
@@ -86,12 +109,21 @@ class StepCounter:
         Y = Y.copy()
         Y[Y < self.steptol] = 0
 
+        # the walk detector's features are computed once here, rather than
+        # in every CV fold and again for the final fit
+        if isinstance(self.wd, WalkDetectorRF):
+            Xwd, fit_method, predict_method = self.wd.featurize(X), 'fit_features', 'predict_features'
+        else:
+            Xwd, fit_method, predict_method = X, 'fit', 'predict'
+
         # train walk detector & cross-val-predict
         if self.verbose:
             print("Running cross_val_predict...")
         self.wd.n_jobs = 1
         Wp, cv_test_idxs = cvp(
-            self.wd, X, W, groups=groups,
+            self.wd, Xwd, W, groups=groups,
+            method=predict_method,
+            fit_method=fit_method,
             fit_predict_groups=True,
             n_splits=self.cv,
             n_jobs=self.n_jobs,
@@ -103,7 +135,7 @@ class StepCounter:
 
         if self.verbose:
             print("Fitting walk detector...")
-        self.wd.fit(X, W, groups=groups)
+        getattr(self.wd, fit_method)(Xwd, W, groups=groups)
 
         # train step counter
         Xw, Yw = X[whr_walk_pred], Y[whr_walk_pred]
@@ -112,8 +144,11 @@ class StepCounter:
         sample_weight = calc_sample_weight(W, self.pnr)
         sample_weight_w = sample_weight[whr_walk_pred]
 
+        # candidate peaks and prominences are found once for all evaluations
+        peak_counter = PeakCounter(Vw, self.sample_rate)
+
         def mae(x):
-            Ywp = batch_count_peaks_from_V(Vw, self.sample_rate, to_params(x))
+            Ywp = peak_counter.count(to_params(x))
             err = metrics.mean_absolute_error(Yw, Ywp, sample_weight=sample_weight_w)
             return err
 
@@ -126,17 +161,22 @@ class StepCounter:
 
         if self.verbose:
             print("Tuning step counter...")
-        res = minimize(
-            mae,
-            x0=[.5, .5],
-            bounds=[
-                (.2, 2),  # 0.2s to 2s (4Hz - 0.5Hz)
-                (.15, 1),  # 0.15g to 1g
-            ],
-            method='Nelder-Mead'
-        )
-
-        self.find_peaks_params = to_params(res.x)
+        if self.optimizer == 'grid':
+            # global optimum over 0.2s to 2s (4Hz - 0.5Hz) and 0.15g to 1g
+            self.find_peaks_params, self.tuning_surface = grid_search_find_peaks_params(
+                peak_counter, Yw, sample_weight_w
+            )
+        else:
+            res = minimize(
+                mae,
+                x0=[.5, .5],
+                bounds=[
+                    (.2, 2),  # 0.2s to 2s (4Hz - 0.5Hz)
+                    (.15, 1),  # 0.15g to 1g
+                ],
+                method='Nelder-Mead'
+            )
+            self.find_peaks_params = to_params(res.x)
 
         # performance -- walk detector
         _, wd_scores = get_cv_scores(
@@ -147,7 +187,7 @@ class StepCounter:
 
         # performance -- step count
         Yp = np.zeros_like(Y)
-        Yp[whr_walk_pred] = batch_count_peaks_from_V(Vw, self.sample_rate, self.find_peaks_params)
+        Yp[whr_walk_pred] = peak_counter.count(self.find_peaks_params)
         _, sc_scores = get_cv_scores(
             Y, Yp, cv_test_idxs,
             sample_weight=sample_weight,
@@ -156,10 +196,9 @@ class StepCounter:
 
         # performance -- step count, walk periods only
         whr_walk_true = W == 1
-        walk_true_idxs = np.flatnonzero(whr_walk_true)
         _, sc_scores_walk = get_cv_scores(
             Y[whr_walk_true], Yp[whr_walk_true],
-            [np.flatnonzero(np.isin(walk_true_idxs, idxs)) for idxs in cv_test_idxs],
+            subset_cv_indices(cv_test_idxs, whr_walk_true),
             sample_weight=sample_weight[whr_walk_true],
             scorer_type='regress'
         )
@@ -188,8 +227,10 @@ class StepCounter:
             print("Model not yet trained. Call .fit() first.")
             return
 
+        X = self.resample(X)
+
         # check X quality
-        whr_ok = ~(np.asarray([np.isnan(x).any() for x in X]))
+        whr_ok = ~np.isnan(X).any(axis=(1, 2))
 
         X_ = X[whr_ok]
         W_ = self.wd.predict(X_, groups).astype('bool')
@@ -208,23 +249,195 @@ class StepCounter:
 
     def predict_from_frame(self, data, **kwargs):
 
-        def fn(chunk):
-            """ Process the chunk. Apply padding if length is not enough. """
-            n = len(chunk)
-            x = chunk[['x', 'y', 'z']].to_numpy()
-            if n > self.window_len:
-                x = x[:self.window_len]
-            if n < self.window_len:
-                m = self.window_len - n
-                x = np.pad(x, ((0, m), (0, 0)), mode='wrap')
-            return x
-
-        X, T = make_windows(data, self.window_sec, fn=fn, return_index=True)
-        X = np.asarray(X)
+        X, T = make_windows_array(data, self.window_sec, self.input_window_len)
         Y = self.predict(X, **kwargs)
         Y = pd.Series(Y, index=T)
         return Y
 
+    def save(self, path, cv_results=True):
+        """
+        Save to directory path with one file per component: the walk
+        detector's forest (clf.joblib) or SSL weights (state_dict.pt), its
+        HMM matrices (hmm.npz), the find_peaks_params (JSON), optionally the
+        CV diagnostics (cv_results.joblib) and the rest (step_counter.joblib).
+        See StepCounter.load.
+        """
+
+        if self.find_peaks_params is None:
+            raise ValueError("Model not yet trained. Call .fit() first.")
+
+        os.makedirs(path, exist_ok=True)
+
+        shell = copy(self)
+        shell.wd = copy(self.wd)
+        shell.wd.hmms = copy(self.wd.hmms)
+
+        if isinstance(self.wd, WalkDetectorRF):
+            joblib.dump(self.wd.clf, os.path.join(path, 'clf.joblib'))
+            shell.wd.clf = None
+        else:
+            torch.save(self.wd.state_dict, os.path.join(path, 'state_dict.pt'))
+            shell.wd.state_dict = None
+
+        hmms = self.wd.hmms
+        np.savez(
+            os.path.join(path, 'hmm.npz'),
+            startprob=hmms.startprob,
+            emissionprob=hmms.emissionprob,
+            transmat=hmms.transmat,
+            labels=hmms.labels,
+        )
+        shell.wd.hmms.startprob = shell.wd.hmms.emissionprob = shell.wd.hmms.transmat = None
+        shell.wd.hmms.labels = None
+
+        with open(os.path.join(path, 'find_peaks_params.json'), 'w') as f:
+            json.dump({k: float(v) for k, v in self.find_peaks_params.items()}, f)
+        shell.find_peaks_params = None
+
+        shell.cv_results = shell.tuning_surface = None
+        if cv_results:
+            joblib.dump(
+                {'cv_results': self.cv_results, 'tuning_surface': self.tuning_surface},
+                os.path.join(path, 'cv_results.joblib')
+            )
+
+        joblib.dump(shell, os.path.join(path, 'step_counter.joblib'))
+
+    @classmethod
+    def load(cls, path, mmap_mode=None, cv_results=False):
+        """
+        Load a StepCounter saved with save(). Only what predict needs is read
+        unless cv_results. mmap_mode (as in joblib.load) memory maps the CV
+        arrays only: the forest is always read fully into memory, as sklearn
+        trees copy their node arrays when unpickled.
+        """
+
+        sc = joblib.load(os.path.join(path, 'step_counter.joblib'))
+
+        if isinstance(sc.wd, WalkDetectorRF):
+            sc.wd.clf = joblib.load(os.path.join(path, 'clf.joblib'), mmap_mode=mmap_mode)
+        else:
+            sc.wd.state_dict = torch.load(os.path.join(path, 'state_dict.pt'), map_location='cpu')
+
+        with np.load(os.path.join(path, 'hmm.npz')) as hmm:
+            sc.wd.hmms.startprob = hmm['startprob']
+            sc.wd.hmms.emissionprob = hmm['emissionprob']
+            sc.wd.hmms.transmat = hmm['transmat']
+            sc.wd.hmms.labels = hmm['labels']
+
+        with open(os.path.join(path, 'find_peaks_params.json')) as f:
+            sc.find_peaks_params = json.load(f)
+
+        cv_path = os.path.join(path, 'cv_results.joblib')
+        if cv_results and os.path.exists(cv_path):
+            diagnostics = joblib.load(cv_path, mmap_mode=mmap_mode)
+            sc.cv_results = diagnostics['cv_results']
+            sc.tuning_surface = diagnostics['tuning_surface']
+
+        return sc
+
+    def resample(self, X, cache=True):
+        """ Windows at input_sample_rate to windows at sample_rate """
+        if self.input_sample_rate == self.sample_rate:
+            return X
+        return features.resample_windows(
+            X, self.input_sample_rate, self.sample_rate,
+            cache_dir=self.resample_cache_dir if cache else None,
+        )
+
+    def predict_from_file(self, datafile, outfile=None, chunksize=1_000_000, lag=60):
+        """
+        Like predict_from_frame, but reading the recording (a CSV file with
+        timestamp, x, y, z columns, sorted by time) chunksize rows at a time, so
+        that memory is bounded by the chunk size. The walk detector's HMM is
+        run with fixed-lag smoothing (see hmm_utils.OnlineHMMSmoother), so
+        its state carries across chunks. If outfile is given, the step
+        counts are appended to it as CSV as soon as they are decided.
+        """
+
+        if self.find_peaks_params is None:
+            print("Model not yet trained. Call .fit() first.")
+            return
+
+        smoother = hmm_utils.OnlineHMMSmoother(self.wd.hmms, lag=lag)
+        window = pd.Timedelta(seconds=self.window_sec)
+
+        # windows waiting for their walk/non-walk decision
+        pending_T = pd.Series([], dtype='datetime64[ns]')
+        pending_ok = np.zeros(0, dtype='bool')
+        pending_counts = np.zeros(0)  # one per ok window
+        decided_W = np.zeros(0, dtype='int')
+        outputs = []
+
+        def release(final=False):
+            nonlocal pending_T, pending_ok, pending_counts, decided_W
+            okpos = np.flatnonzero(pending_ok)
+            nready = len(decided_W)
+            cut = okpos[nready] if nready < len(okpos) else len(pending_ok)
+            if final:
+                cut = len(pending_ok)
+            nok = pending_ok[:cut].sum()
+            Y = np.full(cut, fill_value=np.nan)
+            Y[pending_ok[:cut]] = np.where(decided_W[:nok] == 1, pending_counts[:nok], 0)
+            Y = pd.Series(Y, index=pending_T.iloc[:cut].to_numpy(), name='steps')
+            Y.index.name = 'timestamp'  # as in the input, so that outputs can be read back alike
+            pending_T = pending_T.iloc[cut:]
+            pending_ok = pending_ok[cut:]
+            pending_counts = pending_counts[nok:]
+            decided_W = decided_W[nok:]
+            if outfile is not None and (len(Y) or not outputs):
+                Y.to_csv(outfile, mode='a' if outputs else 'w', header=not outputs)
+            outputs.append(Y)
+
+        def process(data, origin, drop_last):
+            nonlocal pending_T, pending_ok, pending_counts, decided_W
+            X, T = make_windows_array(data, self.window_sec, self.input_window_len, origin=origin)
+            if drop_last:
+                X, T = X[:-1], T.iloc[:-1]
+            X = self.resample(X, cache=False)  # chunks are not reused
+            ok = ~np.isnan(X).any(axis=(1, 2))
+            X_ = X[ok]
+            if len(X_):
+                W_ = self.wd.predict_raw(X_)
+                counts = batch_count_peaks(X_, self.sample_rate, self.lowpass_hz, self.find_peaks_params)
+            else:  # e.g. a chunk of non-wear: the walk detector can't take 0 windows
+                W_, counts = np.zeros(0, dtype='int'), np.zeros(0)
+            pending_T = pd.concat([pending_T, T]) if len(pending_T) else T
+            pending_ok = np.concatenate([pending_ok, ok])
+            pending_counts = np.concatenate([pending_counts, counts])
+            if len(W_):
+                decided_W = np.concatenate([decided_W, smoother.update(W_)])
+            release()
+
+        reader = pd.read_csv(
+            datafile,
+            usecols=['timestamp', 'x', 'y', 'z'],
+            index_col='timestamp',
+            parse_dates=['timestamp'],
+            dtype={'x': 'f4', 'y': 'f4', 'z': 'f4'},
+            chunksize=chunksize,
+        )
+
+        origin = None
+        carry = None
+        for chunk in reader:
+            data = chunk if carry is None else pd.concat([carry, chunk])
+            if origin is None:
+                origin = data.index[0]
+            # the last window may continue in the next chunk: redo it then
+            last_start = origin + ((data.index[-1] - origin) // window) * window
+            carry = data[data.index >= last_start]
+            if len(carry) < len(data):
+                process(data, origin, drop_last=True)
+
+        if carry is not None:
+            process(carry, origin, drop_last=False)
+            decided_W = np.concatenate([decided_W, smoother.flush()])
+            release(final=True)
+
+        Y = pd.concat(outputs) if outputs else pd.Series([], dtype='float', name='steps')
+        return Y
+
 
 class WalkDetectorRF:
     def __init__(
@@ -237,6 +450,8 @@ class WalkDetectorRF:
         cv=5,
         clf_params=None,
         hmm_params=None,
+        soft_evidence=False,
+        cache_dir=None,
         n_jobs=-1,
         verbose=False,
     ):
@@ -252,8 +467,16 @@ class WalkDetectorRF:
         self.n_jobs = n_jobs
         self.verbose = verbose
 
+        # smooth the predicted probabilities rather than the thresholded predictions
+        self.soft_evidence = soft_evidence
+
+        # if set, features are cached on disk (see features.FeatureCache);
+        # only the path is kept here, the cache is shared per process
+        self.cache_dir = cache_dir
+
         clf_params = clf_params or dict()
         hmm_params = hmm_params or dict()
+        self.hmm_params = hmm_params
 
         self.clf = BalancedRandomForestClassifier(
             n_estimators=clf_params.get('n_estimators', 1000),
@@ -268,8 +491,12 @@ class WalkDetectorRF:
         self.thresh = 0.5
 
     def fit(self, X, Y, groups=None):
+        return self.fit_features(self.featurize(X), Y, groups=groups)
+
+    def fit_features(self, X_feats, Y, groups=None):
+        """ Like fit, with the features of the windows (see featurize) """
 
-        X_feats = batch_extract_features(X, self.sample_rate, n_jobs=self.n_jobs)
+        X_feats = self._check_features(X_feats)
 
         whr_ok = ~(np.isnan(X_feats).any(1))
         X_feats = X_feats[whr_ok]
@@ -293,22 +520,21 @@ class WalkDetectorRF:
 
             if self.calib_method == 'balanced_accuracy':
                 self.thresh = calib_ops['best_balanced_accuracy']['thresh']
-                Ypp = calib_ops['best_balanced_accuracy']['predicted']
+                Ypp = (Yp[:, 1] >= self.thresh).astype('int')
 
             elif self.calib_method in ('f1', 'precision', 'recall'):
                 # first optimize f1, then adjust for precision or recall if needed
                 self.thresh = calib_ops['best_f1']['thresh']
-                Ypp = calib_ops['best_f1']['predicted']
 
                 if self.calib_method == 'precision':
                     if calib_ops['best_f1']['precision'] < self.precision_tol:
                         self.thresh = calib_ops['best_precision']['thresh']
-                        Ypp = calib_ops['best_precision']['predicted']
 
                 if self.calib_method == 'recall':
                     if calib_ops['best_f1']['recall'] < self.recall_tol:
                         self.thresh = calib_ops['best_recall']['thresh']
-                        Ypp = calib_ops['best_recall']['predicted']
+
+                Ypp = (Yp[:, 1] > self.thresh).astype('int')
 
             else:
                 raise ValueError(f"Unrecognized {self.calib_method=}")
@@ -316,18 +542,51 @@ class WalkDetectorRF:
         else:
             Ypp = Yp
 
+        if self.soft_evidence:
+            Ypp = Yp
+
         self.hmms.fit(Ypp, Y, groups=groups)
 
         return self
 
     def predict(self, X, groups=None):
-        X_feats = batch_extract_features(X, self.sample_rate, n_jobs=self.n_jobs)
-        whr_ok = ~(np.isnan(X_feats).any(1))
-        W = np.zeros(len(X), dtype='int')  # nan defaults to non-walk
-        W[whr_ok] = (self.clf.predict_proba(X_feats[whr_ok])[:, 1] > self.thresh).astype('int')
+        return self.predict_features(self.featurize(X), groups=groups)
+
+    def predict_features(self, X_feats, groups=None):
+        """ Like predict, with the features of the windows (see featurize) """
+        W = self._predict_raw_features(self._check_features(X_feats))
         W = self.hmms.predict(W, groups=groups)
         return W
 
+    def predict_raw(self, X):
+        """ Predictions before HMM smoothing (class probabilities if soft_evidence) """
+        return self._predict_raw_features(self.featurize(X))
+
+    def _predict_raw_features(self, X_feats):
+        whr_ok = ~(np.isnan(X_feats).any(1))
+        if self.soft_evidence:
+            W = np.zeros((len(X), 2))
+            W[:, 0] = 1  # nan defaults to non-walk
+            W[whr_ok] = self.clf.predict_proba(X_feats[whr_ok])
+        else:
+            W = np.zeros(len(X), dtype='int')  # nan defaults to non-walk
+            W[whr_ok] = (self.clf.predict_proba(X_feats[whr_ok])[:, 1] > self.thresh).astype('int')
+        return W
+
+    def featurize(self, X):
+        """ Features of an array of windows, for fit_features and
+        predict_features, to featurize once for several calls """
+        cache = features.get_feature_cache(self.cache_dir) if self.cache_dir is not None else None
+        return batch_extract_features(X, self.sample_rate, n_jobs=self.n_jobs, cache=cache)
+
+    @staticmethod
+    def _check_features(X_feats):
+        X_feats = np.asarray(X_feats)
+        nfeats = len(features.get_feature_names())
+        if X_feats.ndim != 2 or X_feats.shape[1] != nfeats:
+            raise ValueError(f"Expected features of shape (n, {nfeats}), got {X_feats.shape}. Call featurize first.")
+        return X_feats
+
 
 class WalkDetectorSSL:
     def __init__(
@@ -337,22 +596,33 @@ class WalkDetectorSSL:
             weights_path='state_dict.pt',
             repo_tag='v1.0.0',
             hmm_params=None,
+            soft_evidence=False,
+            torchscript_path=None,
             verbose=False,
     ):
         self.device = device
         self.weights_path = weights_path
         self.repo_tag = repo_tag
+        # if set, predict loads this TorchScript model (see save_torchscript) instead of using pytorch hub
+        self.torchscript_path = torchscript_path
         self.batch_size = batch_size
         self.state_dict = None
 
+        # smooth the predicted probabilities rather than the argmax predictions
+        self.soft_evidence = soft_evidence
+
         self.verbose = verbose
 
         hmm_params = hmm_params or dict()
+        self.hmm_params = hmm_params
         self.hmms = hmm_utils.HMMSmoother(**hmm_params)
 
     def fit(self, X, Y, groups=None):
         sslmodel.verbose = self.verbose
 
+        # a TorchScript saved before holds the old weights
+        self.torchscript_path = None
+
         if self.verbose:
             print('Training SSL')
 
@@ -416,6 +686,12 @@ class WalkDetectorSSL:
         return self
 
     def predict(self, X, groups=None):
+        y_pred = self.predict_raw(X)
+        y_pred = self.hmms.predict(y_pred, groups=groups)
+        return y_pred
+
+    def predict_raw(self, X):
+        """ Predictions before HMM smoothing (class probabilities if soft_evidence) """
         sslmodel.verbose = self.verbose
 
         dataset = sslmodel.NormalDataset(X, name='prediction')
@@ -426,36 +702,77 @@ class WalkDetectorSSL:
             num_workers=1,
         )
 
-        model = sslmodel.get_sslnet(tag=self.repo_tag, pretrained=False)
-        model.load_state_dict(self.state_dict)
-        model.to(self.device)
-
-        _, y_pred, _ = sslmodel.predict(model, dataloader, self.device, output_logits=False)
+        model = sslmodel.get_sslnet_cached(
+            tag=self.repo_tag,
+            device=self.device,
+            state_dict=self.state_dict,
+            torchscript_path=self.torchscript_path,
+        )
 
-        y_pred = self.hmms.predict(y_pred, groups=groups)
+        if self.soft_evidence:
+            _, y_pred, _ = sslmodel.predict(model, dataloader, self.device, output_logits=True)
+            y_pred = softmax(y_pred, axis=1)
+        else:
+            _, y_pred, _ = sslmodel.predict(model, dataloader, self.device, output_logits=False)
 
         return y_pred
 
+    def save_torchscript(self, path, window_len=300):
+        """ Save the fitted network as TorchScript for fast cold starts, and
+        use it in predict from now on. window_len is the number of samples
+        per window (300 = 10s at 30Hz) """
+        model = sslmodel.get_sslnet_cached(tag=self.repo_tag, device=self.device, state_dict=self.state_dict)
+        sslmodel.save_torchscript(model, path, (1, 3, window_len))
+        self.torchscript_path = path
+
+
+def make_windows_array(data, window_sec, window_len, origin=None, chunk_size=10_000):
+    """
+    Split data into windows for predict_from_frame. Returns X of shape
+    (n, window_len, 3), where longer windows are truncated and shorter ones
+    wrap-padded, and T with the first timestamp of each window (indexed by
+    window start as in data.resample). Windows falling in gaps of the
+    recording are all NaN, with T NaT. Windows are aligned to origin (the
+    first timestamp by default) and span from the first to the last sample.
+    """
+
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index(kind='mergesort')
+
+    xyz = data[['x', 'y', 'z']].to_numpy()
+    dtype = xyz.dtype if xyz.dtype.kind == 'f' else 'float64'
+
+    if len(data) == 0:
+        return np.empty((0, window_len, 3), dtype=dtype), pd.Series([], dtype=data.index.dtype)
+
+    if origin is None:
+        origin = data.index[0]
+
+    # window id of each sample, same binning as data.resample(origin=origin)
+    wid = np.asarray((data.index - origin) // pd.Timedelta(seconds=window_sec))
+    first_wid = wid[0]
+    wid = wid - first_wid
+    nwins = wid[-1] + 1
+    lens = np.bincount(wid, minlength=nwins)
+    starts = np.r_[0, np.cumsum(lens)[:-1]]
+
+    # sample j of window i is xyz[starts[i] + j % lens[i]]: truncates long
+    # windows and wrap-pads short ones in a single gather
+    X = np.full((nwins, window_len, 3), np.nan, dtype=dtype)
+    nonempty = np.flatnonzero(lens > 0)
+    pos = np.arange(window_len)
+    for i in range(0, len(nonempty), chunk_size):
+        w = nonempty[i:i + chunk_size]
+        X[w] = xyz[starts[w, None] + pos % lens[w, None]]
+
+    T = pd.Series(
+        data.index[np.minimum(starts, len(data) - 1)],
+        index=origin + pd.to_timedelta((first_wid + np.arange(nwins)) * window_sec, unit='s'),
+    )
+    T.index.name = data.index.name
+    T[lens == 0] = pd.NaT
 
-def make_windows(data, window_sec, fn=None, return_index=False):
-    """ Split data into windows """
-
-    if fn is None:
-        def fn(x):
-            return x
-
-    X = [fn(x) for _, x in data.resample(f"{window_sec}s", origin="start")]
-
-    if return_index:
-        T = (
-            data.index
-            .to_series()
-            .resample(f"{window_sec}s", origin="start")
-            .first()
-        )
-        return X, T
-
-    return X
+    return X, T
 
 
 def cvp(
@@ -465,6 +782,7 @@ def cvp(
     return_indices=False,
     n_splits=5,
     n_jobs=-1,
+    fit_method='fit',
 ):
     """ Like cross_val_predict with custom tweaks """
 
@@ -474,24 +792,12 @@ def cvp(
     if isinstance(X, pd.DataFrame):
         X = X.to_numpy()
 
-    def worker(train_idxs, test_idxs):
-        X_train, Y_train, groups_train = X[train_idxs], Y[train_idxs], groups[train_idxs]
-        X_test, Y_test, groups_test = X[test_idxs], Y[test_idxs], groups[test_idxs]
-        
-        m = deepcopy(model)
-        m.n_jobs = 1
-
-        if fit_predict_groups:
-            m.fit(X_train, Y_train, groups=groups_train)
-            Y_test_pred = getattr(m, method)(X_test, groups=groups_test)
-        else:
-            m.fit(X_train, Y_train)
-            Y_test_pred = getattr(m, method)(X_test)
-
-        return Y_test_pred, test_idxs
+    # only the hyperparameters are sent to each task, not e.g. a fitted
+    # forest; large arrays are memmapped by joblib (see max_nbytes)
+    model = _unfitted_copy(model)
 
     results = Parallel(n_jobs=n_jobs)(
-        delayed(worker)(train_idxs, test_idxs)
+        delayed(_cvp_worker)(model, X, Y, groups, train_idxs, test_idxs, method, fit_method, fit_predict_groups)
         for train_idxs, test_idxs in groupkfold(groups, n_splits)
     )
 
@@ -504,56 +810,133 @@ def cvp(
     return Y_pred
 
 
+def _cvp_worker(model, X, Y, groups, train_idxs, test_idxs, method, fit_method, fit_predict_groups):
+    X_train, Y_train, groups_train = X[train_idxs], Y[train_idxs], groups[train_idxs]
+    X_test, groups_test = X[test_idxs], groups[test_idxs]
+
+    m = deepcopy(model)
+    m.n_jobs = 1
+
+    if fit_predict_groups:
+        getattr(m, fit_method)(X_train, Y_train, groups=groups_train)
+        Y_test_pred = getattr(m, method)(X_test, groups=groups_test)
+    else:
+        getattr(m, fit_method)(X_train, Y_train)
+        Y_test_pred = getattr(m, method)(X_test)
+
+    return Y_test_pred, test_idxs
+
+
+def _unfitted_copy(model):
+    """ Copy of model with its parameters only: sklearn estimators are
+    cloned, walk detectors are copied without their fitted forest, weights
+    or HMM """
+    if hasattr(model, 'get_params'):
+        return clone(model)
+    if not isinstance(model, (WalkDetectorRF, WalkDetectorSSL)):
+        return model
+    m = copy(model)
+    if isinstance(model, WalkDetectorRF):
+        m.clf = clone(model.clf)
+        m.thresh = 0.5
+    else:
+        m.state_dict = None
+        m.torchscript_path = None
+    m.hmms = hmm_utils.HMMSmoother(**model.hmm_params)
+    return m
+
+
 def groupkfold(groups, n_splits=5):
     """ Like GroupKFold but ordered """
 
-    ord_unq_grps = groups[np.sort(np.unique(groups, return_index=True)[1])]
-    folds_unq_grps = np.array_split(ord_unq_grps, n_splits)
+    folds = fold_codes(groups, n_splits)
+    # stable sort: each fold's test indices are a contiguous, ascending slice
+    order = np.argsort(folds, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(folds, minlength=n_splits))))
 
-    for unq_grps in folds_unq_grps:
-        mask = np.isin(groups, unq_grps)
-        test_idxs = np.nonzero(mask)
-        train_idxs = np.nonzero(~mask)
+    for k in range(n_splits):
+        test_idxs = order[bounds[k]:bounds[k + 1]]
+        train_idxs = np.flatnonzero(folds != k)
         yield train_idxs, test_idxs
 
 
-def get_cv_scores(yt, yp, cv_test_idxs, sample_weight=None, scorer_type='classif'):
+def fold_codes(groups, n_splits=5):
+    """ Fold of each sample in groupkfold: groups in order of first
+    appearance, split into n_splits consecutive runs """
 
-    classif_scorers = {
-        'accuracy': metrics.accuracy_score,
-        'f1': lambda yt, yp, sample_weight=None: metrics.f1_score(yt, yp, sample_weight=sample_weight, zero_division=0),
-        'precision': lambda yt, yp, sample_weight=None: metrics.precision_score(yt, yp, sample_weight=sample_weight, zero_division=0),
-        'recall': lambda yt, yp, sample_weight=None: metrics.recall_score(yt, yp, sample_weight=sample_weight, zero_division=0),
-        'balanced_accuracy': lambda yt, yp, sample_weight=None: metrics.balanced_accuracy_score(yt, yp, sample_weight=sample_weight)
-    }
+    _, first_idxs, inverse = np.unique(groups, return_index=True, return_inverse=True)
+    group_rank = np.empty(len(first_idxs), dtype='int')
+    group_rank[np.argsort(first_idxs)] = np.arange(len(first_idxs))
+    # same fold sizes as np.array_split
+    fold_sizes = [len(a) for a in np.array_split(np.arange(len(first_idxs)), n_splits)]
+    fold_of_rank = np.repeat(np.arange(n_splits), fold_sizes)
+    return fold_of_rank[group_rank[inverse.reshape(-1)]]
 
-    regress_scorers = {
-        'mae': lambda yt, yp, sample_weight: metrics.mean_absolute_error(yt, yp, sample_weight=sample_weight),
-        'rmse': lambda yt, yp, sample_weight: metrics.mean_squared_error(yt, yp, sample_weight=sample_weight, squared=False),
-        'mape': lambda yt, yp, sample_weight: smooth_mean_absolute_percentage_error(yt, yp, sample_weight=sample_weight),
-    }
 
-    def smooth_mean_absolute_percentage_error(yt, yp, sample_weight=None):
-        yt, yp = yt.copy(), yp.copy()
-        # add 1 where zero to smooth the mape
-        whr = yt == 0
-        yt[whr] += 1
-        yp[whr] += 1
-        return metrics.mean_absolute_percentage_error(yt, yp, sample_weight=sample_weight)
-
-    if scorer_type == 'classif':
-        scorers = classif_scorers
-    elif scorer_type == 'regress':
-        scorers = regress_scorers
+def subset_cv_indices(cv_test_idxs, mask):
+    """ Test indices of each fold restricted to where mask is True, as
+    positions into the subset (e.g. yt[mask]) """
+    pos = np.cumsum(mask) - 1
+    return [pos[idxs[mask[idxs]]] for idxs in cv_test_idxs]
+
+
+def get_cv_scores(yt, yp, cv_test_idxs, sample_weight=None, scorer_type='classif'):
+    """
+    Per-fold scores and their summary. Same as the sklearn metrics (binary
+    0/1 labels for classification, pos_label=1, zero_division=0), but all
+    folds are scored at once: weighted confusion cells of all folds come
+    from one bincount, regression errors from per-fold weighted sums.
+    """
+
+    idxs = np.concatenate([np.asarray(idxs).reshape(-1) for idxs in cv_test_idxs]).astype('int')
+    nfolds = len(cv_test_idxs)
+    fold = np.repeat(np.arange(nfolds), [np.size(idxs) for idxs in cv_test_idxs])
+    yt, yp = np.asarray(yt)[idxs], np.asarray(yp)[idxs]
+    if sample_weight is None:
+        w = np.ones(len(idxs))
     else:
-        raise ValueError(f"Unknown {scorer_type=}")
+        w = np.asarray(sample_weight, dtype='float')[idxs]
+
+    def fold_sum(x):
+        return np.bincount(fold, weights=x, minlength=nfolds)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        if scorer_type == 'classif':
+            cells = np.bincount(
+                fold * 4 + (yt == 1) * 2 + (yp == 1),
+                weights=w, minlength=nfolds * 4
+            ).reshape(nfolds, 4)
+            tn, fp, fn, tp = cells.T
+            # balanced accuracy: mean recall over the classes present in yt
+            support = np.column_stack([tn + fp, tp + fn])
+            class_recall = np.column_stack([tn, tp]) / support
+            class_present = support > 0
+            raw_scores = {
+                'accuracy': (tn + tp) / cells.sum(1),
+                'f1': _safe_div(2 * tp, 2 * tp + fp + fn),
+                'precision': _safe_div(tp, tp + fp),
+                'recall': _safe_div(tp, tp + fn),
+                'balanced_accuracy': (
+                    np.where(class_present, class_recall, 0).sum(1) / class_present.sum(1)
+                ),
+            }
 
-    raw_scores = defaultdict(list)
+        elif scorer_type == 'regress':
+            err = np.abs(yt - yp)
+            # smooth the mape: add 1 to both yt and yp where yt is zero
+            yt_smooth = np.where(yt == 0, 1, np.abs(yt))
+            wsum = fold_sum(w)
+            raw_scores = {
+                'mae': fold_sum(w * err) / wsum,
+                'rmse': np.sqrt(fold_sum(w * err ** 2) / wsum),
+                'mape': fold_sum(w * err / np.maximum(yt_smooth, np.finfo(np.float64).eps)) / wsum,
+            }
+
+        else:
+            raise ValueError(f"Unknown {scorer_type=}")
 
-    for idxs in cv_test_idxs:
-        yt_, yp_, sample_weight_ = yt[idxs], yp[idxs], sample_weight[idxs]
-        for scorer_name, scorer_fn in scorers.items():
-            raw_scores[scorer_name].append(scorer_fn(yt_, yp_, sample_weight=sample_weight_))
+    raw_scores = {key: val.tolist() for key, val in raw_scores.items()}
 
     summary = {}
     for key, val in raw_scores.items():
@@ -567,14 +950,41 @@ def get_cv_scores(yt, yp, cv_test_idxs, sample_weight=None, scorer_type='classif
     return raw_scores, summary
 
 
-def batch_extract_features(X, sample_rate, to_numpy=True, n_jobs=1, verbose=False):
-    """ Extract features for a list or array of windows """
+def _safe_div(num, den):
+    """ num / den, 0 where den is 0 """
+    return np.where(den == 0, 0, num / np.where(den == 0, 1, den))
 
-    X_feats = Parallel(n_jobs=n_jobs)(
-        delayed(features.extract_features)(x, sample_rate)
-        for x in tqdm(X, disable=not verbose)
-    )
-    X_feats = pd.DataFrame(X_feats)
+
+def batch_extract_features(X, sample_rate, to_numpy=True, n_jobs=1, verbose=False, cache=None):
+    """ Extract features for a list or array of windows. If a features.FeatureCache
+    is given, only windows not already in it are featurized (arrays of windows only). """
+
+    if isinstance(X, np.ndarray) and X.ndim == 3:
+        names = features.get_feature_names()
+
+        if cache is not None:
+            keys = cache.keys(X, sample_rate)
+            X_feats, missing = cache.get(keys, len(names))
+            if missing.any():
+                X_feats[missing] = batch_extract_features(X[missing], sample_rate, n_jobs=n_jobs, verbose=verbose)
+                cache.put([k for k, m in zip(keys, missing) if m], X_feats[missing])
+
+        else:
+            # use the vectorized extractor, in chunks across jobs
+            chunk_size = 1000
+            X_feats = Parallel(n_jobs=n_jobs)(
+                delayed(features.batch_extract_features)(X[i:i + chunk_size], sample_rate, chunk_size)
+                for i in tqdm(range(0, len(X), chunk_size), disable=not verbose)
+            )
+            X_feats = np.vstack([np.empty((0, len(names)), dtype='float32'), *X_feats])
+
+        X_feats = pd.DataFrame(X_feats, columns=names)
+    else:
+        X_feats = Parallel(n_jobs=n_jobs)(
+            delayed(features.extract_features)(x, sample_rate)
+            for x in tqdm(X, disable=not verbose)
+        )
+        X_feats = pd.DataFrame(X_feats)
 
     if to_numpy:
         X_feats = X_feats.to_numpy()
@@ -589,21 +999,174 @@ def batch_count_peaks(X, sample_rate, lowpass_hz, params):
 
 def batch_count_peaks_from_V(V, sample_rate, params):
     """ Count number of peaks for an array of signals """
-    Y = np.asarray([
-        len(find_peaks(
-            v,
-            distance=params["distance"] * sample_rate,
-            prominence=params["prominence"],
-        )[0]) for v in V
-    ])
-    return Y
-
-
-def toV(x, sample_rate, lowpass_hz):
-    V = np.linalg.norm(x, axis=-1)
-    V = V - 1
-    V = np.clip(V, -2, 2)
-    V = features.butterfilt(V, lowpass_hz, sample_rate, axis=-1)
+    if kernels.HAS_NUMBA:
+        return kernels.count_peaks(V, params["distance"] * sample_rate, params["prominence"])
+    return PeakCounter(V, sample_rate).count(params)
+
+
+class PeakCounter:
+    """
+    Count peaks of many signals for many find_peaks parameters. The
+    candidate peaks (local maxima) of all rows of V and their prominences
+    are found once, as neither depend on the parameters. Counting then only
+    filters the candidates by distance and prominence. The same count as
+    len(find_peaks(v, distance=..., prominence=...)[0]) for each row of V,
+    except for ties, which are ranked as in kernels.count_peaks (see there).
+    """
+
+    def __init__(self, V, sample_rate):
+        V = np.asarray(V, dtype='f8')
+        nrows, n = V.shape
+        self.sample_rate = sample_rate
+        self.nrows = nrows
+
+        # all rows in one signal, separated by +inf so that peaks and
+        # prominences do not cross rows
+        x = np.full((nrows, n + 1), np.inf)
+        x[:, :n] = V
+        x = x.ravel()
+        peaks, _ = find_peaks(x)
+        peaks = peaks[peaks % (n + 1) < n]  # drop the separators
+        prominences, _, _ = peak_prominences(x, peaks)
+
+        row, pos = np.divmod(peaks, n + 1)
+        height = x[peaks]
+
+        # by row, then by priority for the distance filter (highest peak first)
+        order = np.lexsort((height, row))
+        row, pos, prominences = row[order], pos[order], prominences[order]
+        counts = np.bincount(row, minlength=nrows)
+        ends = np.cumsum(counts)
+        self.rank = ends[row] - 1 - np.arange(len(row))  # 0 = highest in row
+        self.row = row
+        self.pos = pos
+        self.prominences = prominences
+        self.max_rank = counts.max(initial=0)
+
+        self._kept = {}
+
+    def count(self, params):
+        distance = params["distance"] * self.sample_rate
+        if distance < 1:
+            raise ValueError('`distance` must be greater or equal to 1')
+        distance = np.ceil(distance)
+        whr = self.kept(distance) & (self.prominences >= params["prominence"])
+        return np.bincount(self.row[whr], minlength=self.nrows)
+
+    def count_grid(self, distance, prominences):
+        """ Counts (nrows, len(prominences)) for one distance (in samples,
+        rounded up as in find_peaks) and several prominences at once """
+        if distance < 1:
+            raise ValueError('`distance` must be greater or equal to 1')
+        kept = self.select_by_distance(np.ceil(distance))
+        prominences = np.asarray(prominences)
+        # number of thresholds passed by each candidate
+        npassed = np.searchsorted(np.sort(prominences), self.prominences[kept], side='right')
+        counts = np.bincount(
+            self.row[kept] * (len(prominences) + 1) + npassed,
+            minlength=self.nrows * (len(prominences) + 1)
+        ).reshape(self.nrows, -1)
+        counts = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        return counts[:, np.argsort(np.argsort(prominences))]
+
+    def kept(self, distance):
+        """ Cached select_by_distance, for the last few distances used """
+        if distance not in self._kept:
+            if len(self._kept) >= 16:
+                self._kept.pop(next(iter(self._kept)))
+            self._kept[distance] = self.select_by_distance(distance)
+        return self._kept[distance]
+
+    def select_by_distance(self, distance):
+        """ Candidates kept by the distance filter: from highest to lowest,
+        keep a peak if no kept peak in its row is closer than distance """
+
+        rank_order = np.argsort(self.rank, kind='stable')
+        rank_starts = np.searchsorted(self.rank[rank_order], np.arange(self.max_rank + 1))
+
+        kept = np.zeros(len(self.row), dtype='bool')
+        kept_pos = np.full((self.nrows, self.max_rank), -2 * distance - 1)
+        for r in range(self.max_rank):
+            c = rank_order[rank_starts[r]:rank_starts[r + 1]]
+            rows, pos = self.row[c], self.pos[c]
+            ok = ~np.any(np.abs(kept_pos[rows, :r] - pos[:, None]) < distance, axis=1)
+            kept[c[ok]] = True
+            kept_pos[rows[ok], r] = pos[ok]
+
+        return kept
+
+
+def grid_search_find_peaks_params(peak_counter, Y, sample_weight=None, distances=None, prominences=None):
+    """
+    Exhaustive search of the find_peaks parameters that minimize the mean
+    absolute error of the peak counts of a PeakCounter. By default, every
+    distance from 0.2s to 2s in whole samples, and prominences from 0.15g to
+    1g in steps of 0.01g. Distances (in secs) given by the caller are rounded
+    up to whole samples, as find_peaks does. The search runs over sample
+    counts; the returned distances in secs map back to those sample counts.
+    Returns the best parameters and the error surface.
+    """
+
+    sample_rate = peak_counter.sample_rate
+    if distances is None:
+        distances = np.arange(np.ceil(.2 * sample_rate), np.floor(2 * sample_rate) + 1)
+    else:
+        distances = np.unique(np.ceil(np.asarray(distances) * sample_rate))
+    if prominences is None:
+        prominences = np.round(np.arange(.15, 1.001, .01), 2)
+
+    mae = np.zeros((len(distances), len(prominences)))
+    for i, distance in enumerate(distances):
+        counts = peak_counter.count_grid(distance, prominences)
+        mae[i] = np.average(np.abs(Y[:, None] - counts), axis=0, weights=sample_weight)
+
+    distances = np.asarray([_samples_to_secs(d, sample_rate) for d in distances])
+
+    i, j = np.unravel_index(np.argmin(mae), mae.shape)
+    params = {
+        "distance": distances[i],
+        "prominence": prominences[j],
+    }
+    surface = {
+        "distance": distances,
+        "prominence": prominences,
+        "mae": mae,
+    }
+
+    return params, surface
+
+
+def _samples_to_secs(distance, sample_rate):
+    """ Distance in secs that find_peaks, which takes ceil(secs * sample_rate),
+    maps back to `distance` samples """
+    secs = distance / sample_rate
+    while np.ceil(secs * sample_rate) > distance:
+        secs = np.nextafter(secs, 0)
+    return secs
+
+
+def toV(x, sample_rate, lowpass_hz, dtype='float64', chunk_size=4096):
+    """
+    Lowpassed acceleration magnitude (minus 1g, clipped to +/-2g) of each
+    window in x of shape (n, N, 3). Windows are processed chunk_size at a
+    time into a preallocated output, so that temporaries stay bounded for
+    long recordings. Use dtype='float32' to also compute the magnitude and
+    filter in single precision: wider input is cast chunk by chunk.
+    """
+    x = np.asarray(x)
+    dtype = np.dtype(dtype)
+    sos = features.butter_sos(lowpass_hz, sample_rate).astype(dtype)
+    V = np.empty(x.shape[:-1], dtype=dtype)
+    if x.ndim < 3:  # single window
+        chunk_size = len(x)
+    for i in range(0, len(x), max(chunk_size, 1)):
+        xi = x[i:i + chunk_size]
+        if xi.dtype.itemsize > dtype.itemsize:
+            xi = xi.astype(dtype)
+        v = np.linalg.norm(xi, axis=-1)
+        v -= 1
+        np.clip(v, -2, 2, out=v)
+        V[i:i + chunk_size] = sosfiltfilt(sos, v, axis=-1)
     return V
 
 
@@ -619,12 +1182,41 @@ def classification_report(yt, yp, pnr=1.0):
     return metrics.classification_report(yt, yp, sample_weight=calc_sample_weight(yt, pnr=pnr))
 
 
-def calibrate(yp, yt, pnr=1.0, precision_tol=0.9, recall_tol=0.9):
+def calibrate(yp, yt, pnr=1.0, precision_tol=0.9, recall_tol=0.9, return_predicted=False):
+    """
+    Best thresholds of the scores yp for balanced accuracy, F1, precision
+    and recall. The PR and ROC curves (as sklearn's precision_recall_curve
+    and roc_curve) come from a single sort of the scores and a cumulative
+    sweep of the weighted true and false positives. The thresholded
+    predictions at the best thresholds are only included if return_predicted.
+    """
+
     sample_weight = calc_sample_weight(yt, pnr)
-    precision, recall, thresh_pr = metrics.precision_recall_curve(yt, yp, sample_weight=sample_weight)
-    fpr, tpr, thresh_roc = metrics.roc_curve(yt, yp, sample_weight=sample_weight)
-    f1 = stats.hmean(np.asarray([precision, recall]), axis=0)
-    balanced_accuracy = (tpr + (1 - fpr)) / 2
+    if not np.any(sample_weight):
+        raise ValueError("Sample weights must contain at least one non-zero number.")
+    fps, tps, thresholds = binary_clf_curve(yt, yp, sample_weight)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        # precision-recall curve, by decreasing recall
+        precision = np.hstack((_safe_div(tps, tps + fps)[::-1], 1))
+        if tps[-1] == 0:
+            recall = np.ones_like(tps)
+        else:
+            recall = tps / tps[-1]
+        recall = np.hstack((recall[::-1], 0))
+        thresh_pr = thresholds[::-1]
+        f1 = 2 / (1 / precision + 1 / recall)
+
+        # roc curve, without the points collinear with their neighbours
+        if len(fps) > 2:
+            corners = np.flatnonzero(np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True])
+            fps, tps, thresholds = fps[corners], tps[corners], thresholds[corners]
+        fps, tps = np.r_[0, fps], np.r_[0, tps]
+        thresh_roc = np.r_[np.inf, thresholds.astype('float64')]
+        fpr = fps / fps[-1] if fps[-1] > 0 else np.full(fps.shape, np.nan)
+        tpr = tps / tps[-1] if tps[-1] > 0 else np.full(tps.shape, np.nan)
+        balanced_accuracy = (tpr + (1 - fpr)) / 2
 
     # optimize for balanced accuracy
     balanced_accuracy_idx = np.argmax(balanced_accuracy)
@@ -634,7 +1226,6 @@ def calibrate(yp, yt, pnr=1.0, precision_tol=0.9, recall_tol=0.9):
         'balanced_accuracy': balanced_accuracy[balanced_accuracy_idx],
         'tpr': tpr[balanced_accuracy_idx],
         'fpr': fpr[balanced_accuracy_idx],
-        'predicted': (yp >= balanced_accuracy_thresh).astype('int'),
     }
 
     # optimize for F1
@@ -645,7 +1236,6 @@ def calibrate(yp, yt, pnr=1.0, precision_tol=0.9, recall_tol=0.9):
         'f1': f1[f1_idx],
         'precision': precision[f1_idx],
         'recall': recall[f1_idx],
-        'predicted': (yp > f1_thresh).astype('int'),
     }
 
     # optimize for precision
@@ -656,7 +1246,6 @@ def calibrate(yp, yt, pnr=1.0, precision_tol=0.9, recall_tol=0.9):
         'f1': f1[precision_idx],
         'precision': precision[precision_idx],
         'recall': recall[precision_idx],
-        'predicted': (yp > precision_thresh).astype('int'),
     }
 
     # optimize for recall
@@ -667,9 +1256,14 @@ def calibrate(yp, yt, pnr=1.0, precision_tol=0.9, recall_tol=0.9):
         'f1': f1[recall_idx],
         'precision': precision[recall_idx],
         'recall': recall[recall_idx],
-        'predicted': (yp > recall_thresh).astype('int'),
     }
 
+    if return_predicted:
+        best_balanced_accuracy['predicted'] = (yp >= balanced_accuracy_thresh).astype('int')
+        best_f1['predicted'] = (yp > f1_thresh).astype('int')
+        best_precision['predicted'] = (yp > precision_thresh).astype('int')
+        best_recall['predicted'] = (yp > recall_thresh).astype('int')
+
     results = {
         'precision': precision,
         'recall': recall,
@@ -688,5 +1282,22 @@ def calibrate(yp, yt, pnr=1.0, precision_tol=0.9, recall_tol=0.9):
     return results
 
 
+def binary_clf_curve(yt, yp, sample_weight):
+    """ Weighted false and true positives at each distinct threshold of the
+    scores yp, by decreasing threshold (positive class is 1) """
+
+    order = np.argsort(yp, kind='mergesort')[::-1]
+    yp = np.asarray(yp)[order]
+    yt = (np.asarray(yt)[order] == 1).astype('float64')
+    weight = np.asarray(sample_weight)[order]
+
+    # last index of each run of equal scores
+    threshold_idxs = np.r_[np.flatnonzero(np.diff(yp)), len(yp) - 1]
+    tps = np.cumsum(yt * weight, dtype='float64')[threshold_idxs]
+    fps = np.cumsum((1 - yt) * weight, dtype='float64')[threshold_idxs]
+
+    return fps, tps, yp[threshold_idxs]
+
+
 def print_report():
     pass
@@ -14,6 +14,9 @@ from torch.utils.data import DataLoader
 verbose = False
 torch_cache_path = Path(__file__).parent / 'torch_hub_cache'
 
+# networks for prediction, see get_sslnet_cached
+_sslnets = {}
+
 
 class RandomSwitchAxis:
     """
@@ -104,12 +107,12 @@ class NormalDataset(Dataset):
         if self.y is not None:
             y = self.y[idx]
         else:
-            y = np.NaN
+            y = np.nan
 
         if self.pid is not None:
             pid = self.pid[idx]
         else:
-            pid = np.NaN
+            pid = np.nan
 
         if self.transform is not None:
             sample = self.transform(sample)
@@ -226,6 +229,70 @@ def get_sslnet(tag='v1.0.0', pretrained=False):
     return sslnet
 
 
+def get_sslnet_cached(tag='v1.0.0', device='cpu', state_dict=None, torchscript_path=None):
+    """
+    Process-level registry of SSL models for prediction, one per (tag, device).
+    The network is built from pytorch hub once, and the weights are only
+    reloaded when a different state_dict is given. Do not train the returned
+    model, it is shared.
+
+    :param str tag: Tag on the ssl-wearables repo to check out
+    :param str device: pytorch map device
+    :param dict state_dict: Weights to load in the model, required unless torchscript_path
+    :param str torchscript_path: Load the model from this TorchScript file (see save_torchscript)
+        instead, without pytorch hub. Its weights are used as saved, state_dict is ignored.
+    :return: pytorch SSL model, in eval mode
+    :rtype: nn.Module
+    """
+
+    if torchscript_path is not None:
+        key = ('torchscript', str(Path(torchscript_path).resolve()), str(device))
+        if key not in _sslnets:
+            if verbose:
+                print(f'Using TorchScript {torchscript_path}')
+            model = torch.jit.load(str(torchscript_path), map_location=device)
+            _sslnets[key] = {'model': model.eval(), 'state_dict': None}
+        return _sslnets[key]['model']
+
+    if state_dict is None:
+        # the shared network holds random or another model's weights
+        raise ValueError("No weights (state_dict) for the SSL model. Call .fit() first.")
+
+    key = (tag, str(device))
+    if key not in _sslnets:
+        model = get_sslnet(tag=tag, pretrained=False)
+        model.to(device)
+        _sslnets[key] = {'model': model.eval(), 'state_dict': None}
+
+    entry = _sslnets[key]
+    if entry['state_dict'] is not state_dict:
+        entry['model'].load_state_dict(state_dict)
+        entry['state_dict'] = state_dict  # also keeps it alive, so the identity check is safe
+
+    return entry['model']
+
+
+def save_torchscript(model, path, input_shape):
+    """
+    Save a TorchScript (traced) version of the model, which can be loaded
+    with get_sslnet_cached(torchscript_path=path) without pytorch hub. Models
+    previously loaded from path are dropped from the registry.
+
+    :param nn.Module model: pytorch Module
+    :param str path: Output file
+    :param tuple input_shape: Shape of an input batch, e.g. (1, 3, 300)
+    """
+
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), torch.zeros(input_shape, device=device))
+    traced.save(str(path))
+
+    path = str(Path(path).resolve())
+    for key in [key for key in _sslnets if key[:2] == ('torchscript', path)]:
+        del _sslnets[key]
+
+
 def predict(model, data_loader, device, output_logits=False):
     """
     Iterate over the dataloader and do prediction with a pytorch model.
@@ -0,0 +1,148 @@
+""" Benchmark stepcount.models.calibrate against the original version built
+on sklearn's precision_recall_curve and roc_curve, and check that both give
+the same curves, operating points and predictions.
+
+    python benchmarks/bench_calibrate.py [n_cases]
+"""
+
+import os
+import sys
+import time
+import warnings
+import numpy as np
+from scipy import stats
+from sklearn import metrics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import models  # noqa: E402
+
+
+def calibrate_reference(yp, yt, pnr=1.0, precision_tol=0.9, recall_tol=0.9):
+    """ Original calibrate: separate sklearn PR and ROC curves """
+    sample_weight = models.calc_sample_weight(yt, pnr)
+    precision, recall, thresh_pr = metrics.precision_recall_curve(yt, yp, sample_weight=sample_weight)
+    fpr, tpr, thresh_roc = metrics.roc_curve(yt, yp, sample_weight=sample_weight)
+    f1 = stats.hmean(np.asarray([precision, recall]), axis=0)
+    balanced_accuracy = (tpr + (1 - fpr)) / 2
+
+    # optimize for balanced accuracy
+    balanced_accuracy_idx = np.argmax(balanced_accuracy)
+    balanced_accuracy_thresh = thresh_roc[balanced_accuracy_idx]
+    best_balanced_accuracy = {
+        'thresh': balanced_accuracy_thresh,
+        'balanced_accuracy': balanced_accuracy[balanced_accuracy_idx],
+        'tpr': tpr[balanced_accuracy_idx],
+        'fpr': fpr[balanced_accuracy_idx],
+        'predicted': (yp >= balanced_accuracy_thresh).astype('int'),
+    }
+
+    # optimize for F1
+    f1_idx = np.argmax(f1[:-1])
+    f1_thresh = thresh_pr[f1_idx]
+    best_f1 = {
+        'thresh': f1_thresh,
+        'f1': f1[f1_idx],
+        'precision': precision[f1_idx],
+        'recall': recall[f1_idx],
+        'predicted': (yp > f1_thresh).astype('int'),
+    }
+
+    # optimize for precision
+    precision_idx = np.argmax(precision[:-1] > precision_tol)
+    precision_thresh = thresh_pr[precision_idx]
+    best_precision = {
+        'thresh': precision_thresh,
+        'f1': f1[precision_idx],
+        'precision': precision[precision_idx],
+        'recall': recall[precision_idx],
+        'predicted': (yp > precision_thresh).astype('int'),
+    }
+
+    # optimize for recall
+    recall_idx = np.argmax(recall[:-1] > recall_tol)
+    recall_thresh = thresh_pr[recall_idx]
+    best_recall = {
+        'thresh': recall_thresh,
+        'f1': f1[recall_idx],
+        'precision': precision[recall_idx],
+        'recall': recall[recall_idx],
+        'predicted': (yp > recall_thresh).astype('int'),
+    }
+
+    results = {
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'thresh_pr': thresh_pr,
+        'best_precision': best_precision,
+        'best_recall': best_recall,
+        'best_f1': best_f1,
+        'tpr': tpr,
+        'fpr': fpr,
+        'balanced_accuracy': balanced_accuracy,
+        'thresh_roc': thresh_roc,
+        'best_balanced_accuracy': best_balanced_accuracy,
+    }
+
+    return results
+
+
+def same(a, b):
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+    a, b = np.asarray(a), np.asarray(b)
+    return a.shape == b.shape and np.allclose(a, b, rtol=1e-12, atol=0, equal_nan=True)
+
+
+def run(fn, *args, **kwargs):
+    """ Result of fn, or the error it raised """
+    try:
+        return fn(*args, **kwargs)
+    except ValueError as e:
+        return repr(e)
+
+
+def check(n_cases=300, seed=0):
+    rng = np.random.default_rng(seed)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # single-class labels
+        for trial in range(n_cases):
+            n = int(rng.integers(2, 400))
+            yt = (rng.random(n) < rng.uniform(.05, .95)).astype('int')
+            # rounded scores have many ties
+            yp = np.round(rng.random(n), int(rng.integers(1, 4))) if trial % 2 else rng.random(n)
+            if trial % 17 == 0:
+                yt[:] = 1
+            if trial % 19 == 0:
+                yt[:] = 0
+            pnr = (None, 1.0, .3)[trial % 3]
+
+            expected = run(calibrate_reference, yp, yt, pnr)
+            result = run(models.calibrate, yp, yt, pnr, return_predicted=True)
+            if isinstance(expected, str) or isinstance(result, str):
+                assert result == expected, (trial, result, expected)
+            else:
+                assert same(result, expected), trial
+
+    print(f"identical curves, thresholds and predictions on {n_cases} random cases")
+
+
+def bench(n=3_000_000, seed=0):
+    rng = np.random.default_rng(seed)
+    yt = (rng.random(n) < .3).astype('int')
+    yp = np.clip(yt * .3 + rng.random(n) * .7, 0, 1).astype('f4')
+
+    t0 = time.perf_counter()
+    calibrate_reference(yp, yt)
+    t_ref = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    models.calibrate(yp, yt)
+    t_new = time.perf_counter() - t0
+
+    print(f"{n} scores: reference {t_ref:.2f}s, calibrate {t_new:.2f}s")
+
+
+if __name__ == '__main__':
+    check(*map(int, sys.argv[1:]))
+    bench()
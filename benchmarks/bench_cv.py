@@ -0,0 +1,191 @@
+""" Benchmark the cross-validation helpers of stepcount.models against the
+original implementations, and check that both give the same results.
+
+    python benchmarks/bench_cv.py
+"""
+
+import os
+import sys
+import time
+import warnings
+from collections import defaultdict
+import numpy as np
+from sklearn import metrics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import models  # noqa: E402
+
+
+def groupkfold_reference(groups, n_splits=5):
+    """ Original groupkfold: one np.isin per fold """
+
+    ord_unq_grps = groups[np.sort(np.unique(groups, return_index=True)[1])]
+    folds_unq_grps = np.array_split(ord_unq_grps, n_splits)
+
+    for unq_grps in folds_unq_grps:
+        mask = np.isin(groups, unq_grps)
+        test_idxs = np.nonzero(mask)
+        train_idxs = np.nonzero(~mask)
+        yield train_idxs, test_idxs
+
+
+def subset_cv_indices_reference(cv_test_idxs, mask):
+    """ Original walk-only fold indices in StepCounter.fit """
+    whr = np.flatnonzero(mask)
+    return [np.flatnonzero(np.isin(whr, idxs)) for idxs in cv_test_idxs]
+
+
+def get_cv_scores_reference(yt, yp, cv_test_idxs, sample_weight=None, scorer_type='classif'):
+    """ Original get_cv_scores: sklearn metrics, one fold at a time (rmse as
+    the sqrt of mean_squared_error, as squared=False is gone from sklearn) """
+
+    classif_scorers = {
+        'accuracy': metrics.accuracy_score,
+        'f1': lambda yt, yp, sample_weight=None: metrics.f1_score(yt, yp, sample_weight=sample_weight, zero_division=0),
+        'precision': lambda yt, yp, sample_weight=None: metrics.precision_score(yt, yp, sample_weight=sample_weight, zero_division=0),
+        'recall': lambda yt, yp, sample_weight=None: metrics.recall_score(yt, yp, sample_weight=sample_weight, zero_division=0),
+        'balanced_accuracy': lambda yt, yp, sample_weight=None: metrics.balanced_accuracy_score(yt, yp, sample_weight=sample_weight)
+    }
+
+    regress_scorers = {
+        'mae': lambda yt, yp, sample_weight: metrics.mean_absolute_error(yt, yp, sample_weight=sample_weight),
+        'rmse': lambda yt, yp, sample_weight: np.sqrt(metrics.mean_squared_error(yt, yp, sample_weight=sample_weight)),
+        'mape': lambda yt, yp, sample_weight: smooth_mean_absolute_percentage_error(yt, yp, sample_weight=sample_weight),
+    }
+
+    def smooth_mean_absolute_percentage_error(yt, yp, sample_weight=None):
+        yt, yp = yt.copy(), yp.copy()
+        # add 1 where zero to smooth the mape
+        whr = yt == 0
+        yt[whr] += 1
+        yp[whr] += 1
+        return metrics.mean_absolute_percentage_error(yt, yp, sample_weight=sample_weight)
+
+    scorers = classif_scorers if scorer_type == 'classif' else regress_scorers
+
+    raw_scores = defaultdict(list)
+
+    for idxs in cv_test_idxs:
+        yt_, yp_, sample_weight_ = yt[idxs], yp[idxs], sample_weight[idxs]
+        for scorer_name, scorer_fn in scorers.items():
+            raw_scores[scorer_name].append(scorer_fn(yt_, yp_, sample_weight=sample_weight_))
+
+    summary = {}
+    for key, val in raw_scores.items():
+        q0, q25, q50, q75, q100 = np.quantile(val, (0, .25, .5, .75, 1))
+        avg, std = np.mean(val), np.std(val)
+        summary[key] = {
+            'min': q0, 'Q1': q25, 'med': q50, 'Q3': q75, 'max': q100,
+            'mean': avg, 'std': std,
+        }
+
+    return raw_scores, summary
+
+
+def check_groupkfold(seed=0):
+    rng = np.random.default_rng(seed)
+    cases = [
+        np.repeat(np.arange(10), 7),  # contiguous
+        rng.integers(0, 13, 500),  # shuffled
+        np.array([f"p{i}" for i in rng.integers(0, 7, 300)]),  # strings
+        np.array([3, 3, 1, 1, 2]),  # more splits than groups
+        rng.permutation(np.repeat(np.arange(100), 3)),
+    ]
+    for groups in cases:
+        for n_splits in (1, 2, 5, 7, 20):
+            expected = list(groupkfold_reference(groups, n_splits))
+            result = list(models.groupkfold(groups, n_splits))
+            assert len(result) == len(expected)
+            for (train, test), (train_ref, test_ref) in zip(result, expected):
+                assert np.array_equal(train, train_ref[0]) and np.array_equal(test, test_ref[0])
+
+            mask = rng.random(len(groups)) < .4
+            test_idxs = [test for _, test in result]
+            expected = subset_cv_indices_reference(test_idxs, mask)
+            result = models.subset_cv_indices(test_idxs, mask)
+            assert all(np.array_equal(a, b) for a, b in zip(result, expected))
+
+    print(f"identical folds and walk-only indices on {len(cases)} group layouts")
+
+
+def bench_groupkfold(seed=0):
+    rng = np.random.default_rng(seed)
+    for name, groups in (
+        ('int', np.repeat(np.arange(1000), 2000)),
+        ('str', np.repeat(np.array([f"P{i:03d}" for i in range(1000)]), 2000)),
+    ):
+        t0 = time.perf_counter()
+        list(groupkfold_reference(groups, 5))
+        t_ref = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        list(models.groupkfold(groups, 5))
+        t_new = time.perf_counter() - t0
+        print(f"groupkfold, 2M samples in 1000 {name} groups: reference {t_ref:.3f}s, groupkfold {t_new:.3f}s")
+
+    test_idxs = [test for _, test in models.groupkfold(groups, 5)]
+    mask = rng.random(len(groups)) < .3
+    t0 = time.perf_counter()
+    subset_cv_indices_reference(test_idxs, mask)
+    t_ref = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    models.subset_cv_indices(test_idxs, mask)
+    t_new = time.perf_counter() - t0
+    print(f"walk-only indices, 2M samples: reference {t_ref:.3f}s, subset_cv_indices {t_new:.3f}s")
+
+
+def check_cv_scores(n_cases=200, seed=0):
+    rng = np.random.default_rng(seed)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # sklearn warns on single-class folds
+        for trial in range(n_cases):
+            n = rng.integers(5, 300)
+            groups = rng.integers(rng.integers(1, 8), size=n)
+            cv_test_idxs = [test for _, test in models.groupkfold(groups, int(rng.integers(1, 4))) if len(test)]
+            sample_weight = rng.uniform(.1, 2, n) if trial % 2 else np.ones(n)
+
+            p = rng.uniform(0, 1)
+            yt = (rng.random(n) < p).astype('float')
+            yp = (rng.random(n) < p).astype('int')
+            if trial % 7 == 0:
+                yt[:] = 1
+            if trial % 11 == 0:
+                yp[:] = 0
+            cases = [
+                ('classif', yt, yp),
+                ('regress', rng.integers(0, 20, n).astype('float'), rng.integers(0, 20, n).astype('float')),
+            ]
+
+            for scorer_type, yt, yp in cases:
+                expected, expected_summary = get_cv_scores_reference(yt, yp, cv_test_idxs, sample_weight, scorer_type)
+                result, summary = models.get_cv_scores(yt, yp, cv_test_idxs, sample_weight, scorer_type)
+                assert list(result) == list(expected) and list(summary) == list(expected_summary)
+                for key in expected:
+                    assert np.allclose(result[key], expected[key], rtol=1e-12, atol=1e-14), (trial, key)
+
+    print(f"scores match sklearn on {n_cases} random cases")
+
+
+def bench_cv_scores(seed=0):
+    rng = np.random.default_rng(seed)
+    n = 200_000
+    groups = np.repeat(np.arange(100), n // 100)
+    cv_test_idxs = [test for _, test in models.groupkfold(groups, 5)]
+    sample_weight = rng.uniform(.1, 2, n)
+    for scorer_type, yt, yp in (
+        ('classif', (rng.random(n) < .3).astype('float'), (rng.random(n) < .3).astype('int')),
+        ('regress', rng.integers(0, 20, n).astype('float'), rng.integers(0, 20, n).astype('float')),
+    ):
+        t0 = time.perf_counter()
+        get_cv_scores_reference(yt, yp, cv_test_idxs, sample_weight, scorer_type)
+        t_ref = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        models.get_cv_scores(yt, yp, cv_test_idxs, sample_weight, scorer_type)
+        t_new = time.perf_counter() - t0
+        print(f"get_cv_scores {scorer_type}, 200k samples, 5 folds: reference {t_ref:.3f}s, get_cv_scores {t_new:.3f}s")
+
+
+if __name__ == '__main__':
+    check_groupkfold()
+    bench_groupkfold()
+    check_cv_scores()
+    bench_cv_scores()
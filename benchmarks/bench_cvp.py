@@ -0,0 +1,131 @@
+""" Benchmark stepcount.models.cvp against the original version, and check
+that fold predictions are the same.
+
+    python benchmarks/bench_cvp.py
+"""
+
+import os
+import sys
+import time
+import pickle
+import tempfile
+from copy import deepcopy
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from imblearn.ensemble import BalancedRandomForestClassifier
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import models  # noqa: E402
+
+
+def cvp_reference(
+    model, X, Y, groups,
+    method='predict',
+    fit_predict_groups=False,
+    return_indices=False,
+    n_splits=5,
+    n_jobs=-1,
+):
+    """ Original cvp: a closure over the arrays, and the model as given """
+
+    if n_splits == -1:
+        n_splits = len(np.unique(groups))
+
+    if isinstance(X, pd.DataFrame):
+        X = X.to_numpy()
+
+    def worker(train_idxs, test_idxs):
+        X_train, Y_train, groups_train = X[train_idxs], Y[train_idxs], groups[train_idxs]
+        X_test, Y_test, groups_test = X[test_idxs], Y[test_idxs], groups[test_idxs]
+
+        m = deepcopy(model)
+        m.n_jobs = 1
+
+        if fit_predict_groups:
+            m.fit(X_train, Y_train, groups=groups_train)
+            Y_test_pred = getattr(m, method)(X_test, groups=groups_test)
+        else:
+            m.fit(X_train, Y_train)
+            Y_test_pred = getattr(m, method)(X_test)
+
+        return Y_test_pred, test_idxs
+
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(worker)(train_idxs, test_idxs)
+        for train_idxs, test_idxs in models.groupkfold(groups, n_splits)
+    )
+
+    Y_pred = np.concatenate([r[0] for r in results])
+    cv_test_idxs = [r[1] for r in results]
+
+    if return_indices:
+        return Y_pred, cv_test_idxs
+
+    return Y_pred
+
+
+def main(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, 32))
+    Y = (X[:, 0] + rng.normal(size=n) > 0).astype('int')
+    groups = np.repeat(np.arange(20), n // 20)
+    clf = BalancedRandomForestClassifier(
+        n_estimators=30, replacement=True, sampling_strategy='not minority', random_state=42, n_jobs=1,
+    )
+
+    # warm up the workers: the first cvp task makes each of them import
+    # stepcount.models (and torch), a one-time cost of a few seconds
+    models.cvp(clf, X[::25], Y[::25], groups[::25], n_jobs=2)
+
+    for n_jobs in (1, 2):
+        t0 = time.perf_counter()
+        expected, expected_idxs = cvp_reference(clf, X, Y, groups, method='predict_proba', return_indices=True, n_jobs=n_jobs)
+        t_ref = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        result, idxs = models.cvp(clf, X, Y, groups, method='predict_proba', return_indices=True, n_jobs=n_jobs)
+        t_new = time.perf_counter() - t0
+        assert np.array_equal(result, expected)
+        assert all(np.array_equal(a, b) for a, b in zip(idxs, expected_idxs))
+        print(f"n_jobs={n_jobs}: identical fold predictions, reference {t_ref:.2f}s, cvp {t_new:.2f}s")
+
+    # string groups are object arrays, which joblib can't memmap
+    str_groups = np.array([f"g{g}" for g in groups], dtype=object)
+    assert np.array_equal(models.cvp(clf, X, Y, str_groups, method='predict_proba', n_jobs=2), expected)
+
+    # a fitted forest is cloned rather than shipped to every task
+    clf.fit(X, Y)
+    t0 = time.perf_counter()
+    cvp_reference(clf, X, Y, groups, method='predict_proba', n_jobs=2)
+    t_ref = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    result = models.cvp(clf, X, Y, groups, method='predict_proba', n_jobs=2)
+    t_new = time.perf_counter() - t0
+    assert np.array_equal(result, expected)
+    print(f"fitted model ({len(pickle.dumps(clf)) / 2**20:.0f}MB pickled), n_jobs=2: "
+          f"reference {t_ref:.2f}s, cvp {t_new:.2f}s")
+
+    # memmapped inputs
+    with tempfile.TemporaryDirectory() as tmpdir:
+        np.save(os.path.join(tmpdir, 'X.npy'), X)
+        X_mmap = np.load(os.path.join(tmpdir, 'X.npy'), mmap_mode='r')
+        assert np.array_equal(models.cvp(clf, X_mmap, Y, groups, method='predict_proba', n_jobs=2), expected)
+        del X_mmap
+
+    # a fitted walk detector (forest, threshold and HMM) is sent to the
+    # tasks without its fitted parts, and gives the same folds as unfitted
+    wd = models.WalkDetectorRF(clf_params={'n_estimators': 30}, cv=3, n_jobs=1)
+    kw = dict(method='predict_features', fit_method='fit_features', fit_predict_groups=True, n_jobs=2)
+    expected = models.cvp(wd, X, Y, groups, **kw)
+    wd.fit_features(X, Y, groups)
+    t0 = time.perf_counter()
+    result = models.cvp(wd, X, Y, groups, **kw)
+    t_new = time.perf_counter() - t0
+    assert np.array_equal(result, expected)
+    print(f"fitted WalkDetectorRF ({len(pickle.dumps(wd)) / 2**20:.1f}MB pickled, "
+          f"{len(pickle.dumps(models._unfitted_copy(wd))) / 2**10:.0f}kB sent), n_jobs=2: "
+          f"cvp {t_new:.2f}s, same folds as unfitted")
+
+
+if __name__ == '__main__':
+    main()
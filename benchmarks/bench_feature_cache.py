@@ -0,0 +1,78 @@
+""" Check stepcount.features.FeatureCache as used by
+models.batch_extract_features: cached features are the same as freshly
+extracted ones, lookups report exactly the windows not seen before, and
+features written by one cache are read back by another (a later run).
+Also compare the time of a cold and a warm cache.
+
+    python benchmarks/bench_feature_cache.py [n_windows]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import features, models  # noqa: E402
+from bench_features import make_windows  # noqa: E402
+
+
+def main(n=2000, sample_rate=100):
+    n = int(n)
+    X = make_windows(n, sample_rate)
+    nfeats = len(features.get_feature_names())
+
+    t0 = time.perf_counter()
+    expected = models.batch_extract_features(X, sample_rate)
+    print(f"{n} windows: no cache {time.perf_counter() - t0:.2f}s")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = features.FeatureCache(cache_dir)
+        for run in ('cold', 'warm'):
+            t0 = time.perf_counter()
+            feats = models.batch_extract_features(X, sample_rate, cache=cache)
+            elapsed = time.perf_counter() - t0
+            assert np.array_equal(feats, expected, equal_nan=True)
+            print(f"{n} windows: cache ({run}) {elapsed:.2f}s, identical")
+
+        # hits and misses: half of the windows are changed
+        X2 = X.copy()
+        X2[::2] += 1
+        _, missing = cache.get(cache.keys(X2, sample_rate), nfeats)
+        assert np.array_equal(missing, np.arange(n) % 2 == 0)
+        # same windows at another sample rate are other entries
+        assert cache.get(cache.keys(X, 30), nfeats)[1].all()
+        print("cache hits and misses: as expected")
+
+        # the shards are only listed again when a lookup misses
+        listdir, listed = os.listdir, []
+        os.listdir = lambda path: listed.append(path) or listdir(path)
+        try:
+            assert not cache.get(cache.keys(X, sample_rate), nfeats)[1].any()
+        finally:
+            os.listdir = listdir
+        assert not listed
+
+        # another process, or a later run
+        reader = features.FeatureCache(cache_dir)
+        feats, missing = reader.get(reader.keys(X, sample_rate), nfeats)
+        assert not missing.any()
+        assert np.array_equal(feats, expected, equal_nan=True)
+
+        # shards written after the reader's last lookup are found on a miss
+        models.batch_extract_features(X2, sample_rate, cache=cache)
+        feats, missing = reader.get(reader.keys(X2, sample_rate), nfeats)
+        assert not missing.any()
+        assert np.array_equal(feats, models.batch_extract_features(X2, sample_rate), equal_nan=True)
+        print(f"features read back by another cache, identical ({len(os.listdir(cache_dir))} files)")
+
+        # the index is bounded (here by the largest shard, the one of X)
+        bounded = features.FeatureCache(cache_dir, maxsize=n // 2)
+        bounded.get(bounded.keys(X, sample_rate), nfeats)
+        assert len(bounded._index) <= n
+        print(f"cache with maxsize={n // 2}: {len(bounded._index)} windows indexed")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,65 @@
+""" Benchmark stepcount.features.batch_extract_features against the
+per-window extract_features, and check that both give the same features.
+
+    python benchmarks/bench_features.py [n_windows]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import features  # noqa: E402
+
+
+def make_windows(n, sample_rate=100, window_sec=5, seed=0):
+    """ Synthetic walking-like windows, plus constant, low-variance and NaN ones """
+
+    rng = np.random.default_rng(seed)
+    window_len = int(sample_rate * window_sec)
+    t = np.arange(window_len) / sample_rate
+    freq = rng.uniform(.5, 3, size=(n, 1, 1))
+    amp = rng.uniform(0, 1, size=(n, 1, 1))
+    X = 1 / np.sqrt(3) + amp * np.sin(2 * np.pi * freq * t[None, :, None])
+    X = X + rng.normal(scale=.1, size=X.shape)
+    X[0::50] = 1 / np.sqrt(3)  # constant
+    X[1::50] = 1 / np.sqrt(3) + rng.normal(scale=1e-4, size=X[1::50].shape)  # low variance
+    X[2::50, rng.integers(window_len)] = np.nan
+    return X.astype('float32')
+
+
+def extract_features_reference(X, sample_rate):
+    """ One extract_features call per window """
+
+    names = features.get_feature_names()
+    feats = np.full((len(X), len(names)), np.nan, dtype='float32')
+    for i, x in enumerate(X):
+        f = features.extract_features(x, sample_rate)
+        if len(f) > 0:
+            feats[i] = [f[name] for name in names]
+    return feats
+
+
+def main(n=10_000):
+    n = int(n)
+
+    for sample_rate, window_sec in ((100, 5), (30, 10)):
+        X = make_windows(n, sample_rate, window_sec)
+
+        t0 = time.perf_counter()
+        F0 = extract_features_reference(X, sample_rate)
+        t_ref = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        F1 = features.batch_extract_features(X, sample_rate)
+        t_new = time.perf_counter() - t0
+
+        np.testing.assert_allclose(F1, F0, rtol=1e-3, atol=1e-4)
+
+        print(f"{sample_rate}Hz/{window_sec}s, {n} windows: "
+              f"extract_features {t_ref:.2f}s, batch_extract_features {t_new:.2f}s")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,85 @@
+""" Check stepcount.hmm_utils.forward_backward against brute-force
+enumeration of all hidden paths, for hard labels and soft evidence, and
+time it on many groups.
+
+    python benchmarks/bench_forward_backward.py [n_cases]
+"""
+
+import os
+import sys
+import time
+import itertools
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import hmm_utils  # noqa: E402
+
+
+def posteriors_reference(likelihood, prior, transition):
+    """ Posterior of each state at each step, summing over all paths """
+    n, nlabels = likelihood.shape
+    post = np.zeros((n, nlabels))
+    for path in itertools.product(range(nlabels), repeat=n):
+        p = prior[path[0]] * likelihood[0, path[0]]
+        for j in range(1, n):
+            p *= transition[path[j - 1], path[j]] * likelihood[j, path[j]]
+        for j, s in enumerate(path):
+            post[j, s] += p
+    return post / post.sum(axis=1, keepdims=True)
+
+
+def posteriors_reference_groups(likelihood, prior, transition, groups):
+    """ Brute force per group, in the output order of forward_backward """
+    order, lengths = hmm_utils.group_segments(groups)
+    likelihood = likelihood[order]
+    starts = np.r_[0, np.cumsum(lengths)]
+    return np.concatenate([
+        posteriors_reference(likelihood[a:b], prior, transition)
+        for a, b in zip(starts[:-1], starts[1:])
+    ])
+
+
+def check(n_cases=30, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(n_cases):
+        nlabels = rng.integers(2, 4)
+        prior = rng.dirichlet(np.ones(nlabels))
+        transition = rng.dirichlet(np.ones(nlabels), size=nlabels)
+        emission = rng.dirichlet(np.ones(nlabels), size=nlabels)
+        params = {'prior': prior, 'transition': transition, 'emission': emission, 'labels': np.arange(nlabels)}
+
+        lengths = rng.integers(1, 6, size=rng.integers(1, 4))
+        groups = np.repeat(np.arange(len(lengths)), lengths)
+        rng.shuffle(groups)
+
+        # hard labels
+        Y = rng.integers(nlabels, size=len(groups))
+        expected = posteriors_reference_groups(emission[:, Y].T + 1e-16, prior, transition, groups)
+        assert np.allclose(hmm_utils.forward_backward(Y, params, groups), expected, atol=1e-9)
+
+        # soft evidence
+        P = rng.dirichlet(np.ones(nlabels), size=len(groups))
+        expected = posteriors_reference_groups(P @ emission.T + 1e-16, prior, transition, groups)
+        assert np.allclose(hmm_utils.forward_backward(P, params, groups), expected, atol=1e-9)
+
+    print(f"posteriors match brute force on {n_cases} random grouped cases")
+
+
+def bench(seed=0):
+    rng = np.random.default_rng(seed)
+    Y = rng.integers(2, size=150 * 2880)
+    groups = np.repeat(np.arange(150), 2880)
+    hmms = hmm_utils.HMMSmoother().fit(Y, Y, groups)
+
+    t0 = time.perf_counter()
+    post = hmms.predict_proba(Y, groups)
+    print(f"150 groups x 2880: forward_backward {time.perf_counter() - t0:.2f}s")
+
+    # per-step scaling keeps long sequences finite
+    post = hmms.predict_proba(rng.integers(2, size=200_000))
+    assert np.isfinite(post).all() and np.allclose(post.sum(axis=1), 1)
+
+
+if __name__ == '__main__':
+    check(*map(int, sys.argv[1:]))
+    bench()
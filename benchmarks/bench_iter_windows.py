@@ -0,0 +1,50 @@
+""" Check that utils.iter_windows yields the same windows as
+make_windows(load_data(datafile)) for several chunk sizes, and compare
+their time and peak memory.
+
+    python benchmarks/bench_iter_windows.py [hours]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import utils  # noqa: E402
+from bench_make_windows import make_data  # noqa: E402
+
+
+def measure(fn):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fn()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, elapsed, peak / 2**20
+
+
+def main(hours=2.0):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datafile = os.path.join(tmpdir, 'P001.csv.gz')
+        make_data(hours).to_csv(datafile)
+
+        expected, t_ref, mem_ref = measure(lambda: utils.make_windows(utils.load_data(datafile)))
+        print(f"make_windows(load_data()): {t_ref:.2f}s, peak {mem_ref:.0f}MB")
+
+        # smaller than a window, a few windows, the whole file
+        for chunksize in (777, 100_000, 10**9):
+            batches, t_new, mem_new = measure(lambda: list(utils.iter_windows(datafile, chunksize=chunksize)))
+            for arr, expected_arr in zip(zip(*batches), expected):
+                arr = np.concatenate(arr)
+                assert arr.dtype == expected_arr.dtype
+                assert np.array_equal(arr, expected_arr, equal_nan=arr.dtype.kind == 'f')
+            print(f"iter_windows(chunksize={chunksize}): identical, {len(batches)} batches, "
+                  f"{t_new:.2f}s, peak {mem_new:.0f}MB")
+
+
+if __name__ == '__main__':
+    main(*map(float, sys.argv[1:]))
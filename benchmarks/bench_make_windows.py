@@ -0,0 +1,96 @@
+""" Benchmark utils.make_windows against the original resample loop, and
+check that both give the same windows.
+
+    python benchmarks/bench_make_windows.py [hours]
+"""
+
+import os
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import utils  # noqa: E402
+
+
+def make_windows_reference(data, winsec=30, sample_rate=100, dropna=True):
+    """ Original implementation: one resample group at a time """
+
+    X, Y, T = [], [], []
+
+    for t, w in data.resample(f"{winsec}s", origin='start'):
+
+        if len(w) < 1:
+            continue
+
+        t = t.to_numpy()
+
+        x = w[['x', 'y', 'z']].to_numpy()
+
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="Unable to sort modes")
+            y = w['annotation'].mode(dropna=False).iloc[0]
+
+        if dropna and pd.isna(y):  # skip if annotation is NA
+            continue
+
+        if not utils.is_good_window(x, sample_rate, winsec):  # skip if bad window
+            continue
+
+        X.append(x)
+        Y.append(y)
+        T.append(t)
+
+    X = np.stack(X)
+    Y = np.stack(Y)
+    T = np.stack(T)
+
+    return X, Y, T
+
+
+def make_data(hours, sample_rate=100, seed=0):
+    """ Synthetic recording with NaNs, a gap and unannotated stretches """
+
+    rng = np.random.default_rng(seed)
+    n = int(hours * 3600 * sample_rate)
+    index = pd.date_range('2024-01-01 09:00:00.010', periods=n, freq=f"{1000 // sample_rate}ms")
+    data = pd.DataFrame(
+        rng.normal(size=(n, 3)).astype('f4'),
+        columns=['x', 'y', 'z'],
+        index=pd.DatetimeIndex(index, name='time'),
+    )
+    labels = np.array(['sleep', 'sit-stand', 'walking', 'mixed'])
+    annotation = labels[np.repeat(rng.integers(0, len(labels), n // 1000 + 1), 1000)[:n]]
+    data['annotation'] = pd.array(annotation, dtype='string')
+    data.iloc[rng.integers(0, n, 20), 0] = np.nan
+    data.iloc[n // 3:n // 3 + 5000, -1] = pd.NA
+    keep = np.ones(n, dtype='bool')
+    keep[n // 2:n // 2 + 12345] = False  # gap
+    return data[keep]
+
+
+def main(hours=2.0):
+    data = make_data(hours)
+
+    for dropna in (True, False):
+        t0 = time.perf_counter()
+        X0, Y0, T0 = make_windows_reference(data, dropna=dropna)
+        t_ref = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        X1, Y1, T1 = utils.make_windows(data, dropna=dropna)
+        t_new = time.perf_counter() - t0
+
+        assert np.array_equal(X0, X1)
+        assert np.array_equal(pd.isna(Y0), pd.isna(Y1))
+        assert np.array_equal(Y0[~pd.isna(Y0)].astype('str'), Y1[~pd.isna(Y1)].astype('str'))
+        assert np.array_equal(T0, T1)
+
+        print(f"{hours}h, dropna={dropna}, {len(X1)} windows: "
+              f"reference {t_ref:.2f}s, make_windows {t_new:.2f}s")
+
+
+if __name__ == '__main__':
+    main(*map(float, sys.argv[1:]))
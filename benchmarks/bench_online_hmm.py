@@ -0,0 +1,53 @@
+""" Compare stepcount.hmm_utils.OnlineHMMSmoother with offline Viterbi
+decoding for several lags, and time it.
+
+With a lag at least as long as the stream, the online decisions must equal
+the offline path, and for any lag they must not depend on how the stream
+is chunked. Shorter lags trade agreement for latency; the agreement is
+reported.
+
+    python benchmarks/bench_online_hmm.py
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import hmm_utils  # noqa: E402
+
+
+def decode_online(hmms, Y, lag, chunk_size):
+    online = hmm_utils.OnlineHMMSmoother(hmms, lag)
+    decisions = [online.update(Y[i:i + chunk_size]) for i in range(0, len(Y), chunk_size)]
+    decisions.append(online.flush())
+    return np.concatenate(decisions)
+
+
+def main(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    # 3-label stream in runs of 25, observed with 40% noise
+    Y_true = np.repeat(rng.integers(3, size=n // 25), 25)
+    Y_pred = np.where(rng.random(n) < .6, Y_true, rng.integers(3, size=n))
+    hmms = hmm_utils.HMMSmoother().fit(Y_pred, Y_true)
+    offline = hmms.predict(Y_pred)
+
+    for lag in (0, 1, 2, 5, 10, 20, 50, 100, n):
+        online = decode_online(hmms, Y_pred, lag, chunk_size=333)
+        assert np.array_equal(online, decode_online(hmms, Y_pred, lag, chunk_size=n))
+        print(f"lag {lag}: agreement with offline Viterbi {np.mean(online == offline):.3f}")
+    assert np.array_equal(online, offline)
+
+    # soft evidence with one-hot probabilities decodes as the hard labels
+    assert np.array_equal(decode_online(hmms, np.eye(3)[Y_pred], n, chunk_size=n), offline)
+
+    online = hmm_utils.OnlineHMMSmoother(hmms, lag=50)
+    Y = np.tile(Y_pred, 4)
+    t0 = time.perf_counter()
+    online.update(Y)
+    print(f"{len(Y)} observations, lag 50: {time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
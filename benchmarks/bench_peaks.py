@@ -0,0 +1,82 @@
+""" Benchmark the peak counters used by StepCounter (models.PeakCounter and
+kernels.count_peaks) against one scipy.signal.find_peaks call per window,
+and check their counts.
+
+Counts must be equal on continuous signals. On signals rounded to 0.1g,
+equally high peaks make the distance filter depend on how ties are ranked
+(see kernels.count_peaks), so the differing rows are only reported.
+
+    python benchmarks/bench_peaks.py [n_windows]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from scipy.signal import find_peaks
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import kernels, models  # noqa: E402
+
+
+def count_peaks_reference(V, distance, prominence):
+    """ Original batch_count_peaks_from_V: one find_peaks call per row """
+    return np.asarray([
+        len(find_peaks(v, distance=distance, prominence=prominence)[0])
+        for v in V
+    ])
+
+
+def make_V(n, sample_rate=100, window_sec=5, seed=0):
+    """ Synthetic lowpassed magnitudes of walking and non-walking windows,
+    with some flat peaks """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(sample_rate * window_sec)) / sample_rate
+    freq = rng.uniform(1.5, 2.2, size=(n, 1))
+    amp = np.where(rng.random((n, 1)) < .5, rng.uniform(.2, 1, size=(n, 1)), 0)
+    X = np.stack([
+        rng.normal(scale=.15, size=(n, len(t))) + amp * np.sin(2 * np.pi * freq * t),
+        rng.normal(scale=.15, size=(n, len(t))),
+        rng.normal(scale=.15, size=(n, len(t))) + 1,
+    ], axis=-1)
+    V = models.toV(X, sample_rate, lowpass_hz=5)
+    V[::10] = np.repeat(V[::10, :V.shape[1] // 2], 2, axis=1)  # flat peaks
+    return V
+
+
+def counters(sample_rate):
+    yield 'PeakCounter', lambda V, distance, prominence: \
+        models.PeakCounter(V, sample_rate).count({'distance': distance / sample_rate, 'prominence': prominence})
+    if kernels.HAS_NUMBA:
+        yield 'kernels.count_peaks', lambda V, distance, prominence: \
+            kernels.count_peaks(V, distance, prominence)
+
+
+def main(n=100_000, sample_rate=100):
+    n = int(n)
+    V = make_V(n, sample_rate)
+    V_ties = np.round(V, 1)
+    params = [(.5, .5), (1.3, .2), (.2, .15)]
+
+    for name, count in counters(sample_rate):
+        count(V[:10], 50, .5)  # compile
+        for distance, prominence in params:
+            distance = distance * sample_rate
+            expected = count_peaks_reference(V, distance, prominence)
+            assert np.array_equal(count(V, distance, prominence), expected), name
+            ndiff = np.sum(count(V_ties, distance, prominence) != count_peaks_reference(V_ties, distance, prominence))
+            print(f"{name}: distance={distance:g}, prominence={prominence:g}: identical on {n} windows, "
+                  f"{ndiff} windows differ when rounded to 0.1g (ties)")
+
+    distance, prominence = 50, .5
+    t0 = time.perf_counter()
+    count_peaks_reference(V, distance, prominence)
+    print(f"{n} windows: find_peaks {time.perf_counter() - t0:.2f}s")
+    for name, count in counters(sample_rate):
+        t0 = time.perf_counter()
+        count(V, distance, prominence)
+        print(f"{n} windows: {name} {time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
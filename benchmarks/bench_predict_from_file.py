@@ -0,0 +1,85 @@
+""" Check that StepCounter.predict_from_file, which streams the recording in
+chunks, gives the same step counts as predict_from_frame on the whole
+recording, and compare their time and peak memory.
+
+    python benchmarks/bench_predict_from_file.py [hours]
+"""
+
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import models  # noqa: E402
+from bench_toV import measure  # noqa: E402
+
+
+def make_training_windows(n=1500, window_len=500, sample_rate=100, seed=0):
+    """ Synthetic walking (sine on x) and non-walking windows with step counts """
+    rng = np.random.default_rng(seed)
+    t = np.arange(window_len) / sample_rate
+    walk = np.repeat(rng.random(n // 15) < .5, 15)
+    freq = rng.uniform(1.5, 2.2, size=(n, 1))
+    X = rng.normal(0, .15, size=(n, window_len, 3)) + [0, 0, 1]
+    X[walk, :, 0] += (.6 * np.sin(2 * np.pi * freq * t))[walk]
+    Y = np.where(walk, np.round(freq[:, 0] * window_len / sample_rate), rng.integers(0, 3, n))
+    groups = np.repeat(np.arange(10), n // 10)
+    return X.astype('f4'), Y.astype('float'), groups
+
+
+def make_recording(hours, sample_rate=100, seed=0):
+    """ Alternating minutes of walking and rest, with a 10-min gap and a short
+    one, 20 min of NaN (non-wear, longer than some chunks) and NaN at the end """
+    rng = np.random.default_rng(seed)
+    n = int(hours * 3600 * sample_rate)
+    t = pd.date_range('2024-01-01', periods=n, freq=f"{1000 // sample_rate}ms", name='timestamp')
+    x = rng.normal(0, .15, size=(n, 3)) + [0, 0, 1]
+    x[:, 0] += .6 * np.sin(2 * np.pi * 1.8 * np.arange(n) / sample_rate) * (np.arange(n) // 60000 % 2)
+    x[int(.6 * n):int(.6 * n) + 20 * 60 * sample_rate] = np.nan
+    x[-30 * sample_rate:] = np.nan
+    keep = np.ones(n, dtype='bool')
+    keep[n // 5:n // 5 + 60000] = False
+    keep[n // 2:n // 2 + 77] = False
+    return pd.DataFrame(x.astype('f4'), columns=['x', 'y', 'z'], index=t)[keep]
+
+
+def main(hours=1.0):
+    X, Y, groups = make_training_windows()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datafile = os.path.join(tmpdir, 'recording.csv')
+        outfile = os.path.join(tmpdir, 'steps.csv')
+        make_recording(hours).to_csv(datafile)
+        data = pd.read_csv(
+            datafile, index_col='timestamp', parse_dates=['timestamp'],
+            dtype={'x': 'f4', 'y': 'f4', 'z': 'f4'},
+        )
+
+        for soft_evidence in (False, True):
+            sc = models.StepCounter(
+                wd_type='rf', cv=3, n_jobs=1,
+                wd_params={'clf_params': {'n_estimators': 30}, 'soft_evidence': soft_evidence},
+            ).fit(X, Y, groups)
+
+            expected, t_ref, mem_ref = measure(lambda: sc.predict_from_frame(data))
+            print(f"soft_evidence={soft_evidence}: predict_from_frame {t_ref:.2f}s, peak {mem_ref:.0f}MB")
+
+            for chunksize, lag in ((777, 5), (50_000, 60), (100_000, 60), (1_000_000, 1000)):
+                if os.path.exists(outfile):
+                    os.remove(outfile)
+                result, t_new, mem_new = measure(
+                    lambda: sc.predict_from_file(datafile, outfile=outfile, chunksize=chunksize, lag=lag)
+                )
+                assert result.index.equals(expected.index)
+                assert result.index.name == expected.index.name == 'timestamp'
+                assert np.array_equal(result.to_numpy(), expected.to_numpy(), equal_nan=True)
+                written = pd.read_csv(outfile, index_col='timestamp', parse_dates=['timestamp'])['steps']
+                assert np.allclose(written.to_numpy(), result.to_numpy(), equal_nan=True)
+                print(f"  predict_from_file(chunksize={chunksize}, lag={lag}): identical, "
+                      f"{t_new:.2f}s, peak {mem_new:.0f}MB")
+
+
+if __name__ == '__main__':
+    main(*map(float, sys.argv[1:]))
@@ -0,0 +1,55 @@
+""" Check stepcount.features.resample_windows against resampling all windows
+at once with scipy.signal.resample_poly, with and without the on-disk cache,
+and check that a StepCounter given raw-rate data (input_sample_rate) gives
+the same predictions as one trained on pre-resampled windows.
+
+    python benchmarks/bench_resample_windows.py
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from scipy import signal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import models, features  # noqa: E402
+from bench_predict_from_file import make_training_windows  # noqa: E402
+
+
+def main():
+    X, Y, groups = make_training_windows(window_len=1000)
+
+    t0 = time.perf_counter()
+    expected = signal.resample_poly(X, 3, 10, axis=1).astype('f4')
+    t_ref = time.perf_counter() - t0
+    print(f"{len(X)} windows 100Hz -> 30Hz: resample_poly on the whole array {t_ref:.2f}s")
+
+    t0 = time.perf_counter()
+    R = features.resample_windows(X, 100, 30)
+    t_new = time.perf_counter() - t0
+    assert R.dtype == np.float32 and np.array_equal(R, expected)
+    print(f"  resample_windows {t_new:.2f}s, identical")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for run in ('cold', 'warm'):
+            t0 = time.perf_counter()
+            R = features.resample_windows(X, 100, 30, cache_dir=cache_dir)
+            t_new = time.perf_counter() - t0
+            assert np.array_equal(R, expected)
+            print(f"  resample_windows with cache ({run}) {t_new:.2f}s, identical")
+
+        kw = dict(
+            wd_type='rf', wd_params={'clf_params': {'n_estimators': 30}},
+            cv=3, n_jobs=1, window_sec=10, sample_rate=30,
+        )
+        a = models.StepCounter(**kw).fit(expected, Y, groups)
+        b = models.StepCounter(input_sample_rate=100, resample_cache_dir=cache_dir, **kw).fit(X, Y, groups)
+        assert a.find_peaks_params == b.find_peaks_params
+        assert np.array_equal(a.predict(expected, groups), b.predict(X, groups), equal_nan=True)
+        print("StepCounter(input_sample_rate=100) on raw windows: same peak params and predictions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+""" Check that a StepCounter saved with save() and read back with load()
+gives the same predictions, with the random forest and with the SSL walk
+detector, and compare save/load times and sizes on disk.
+
+The SSL network is taken untrained from pytorch hub (downloaded on first
+use) with an HMM fitted on random labels: only the round trip is checked.
+
+    python benchmarks/bench_save_load.py
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import models, sslmodel  # noqa: E402
+from bench_predict_from_file import make_training_windows  # noqa: E402
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def check_round_trip(name, sc, X, groups, tmpdir, **load_kw):
+    path = os.path.join(tmpdir, name)
+    expected = sc.predict(X, groups)
+
+    t0 = time.perf_counter()
+    sc.save(path)
+    t_save = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    loaded = models.StepCounter.load(path, **load_kw)
+    t_load = time.perf_counter() - t0
+
+    assert loaded.find_peaks_params == {k: float(v) for k, v in sc.find_peaks_params.items()}
+    assert np.array_equal(loaded.predict(X, groups), expected, equal_nan=True)
+    print(f"{name}: same predictions after save/load, save {t_save:.2f}s, load {t_load:.2f}s, "
+          f"{dir_size(path) / 2**20:.1f}MB on disk")
+    return loaded
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        # random forest
+        X, Y, groups = make_training_windows()
+        sc = models.StepCounter(wd_type='rf', cv=3, n_jobs=1, wd_params={'clf_params': {'n_estimators': 30}})
+        sc.fit(X, Y, groups)
+        loaded = check_round_trip('rf', sc, X, groups, tmpdir, mmap_mode='r', cv_results=True)
+        assert np.array_equal(loaded.cv_results['step_counter']['y_pred'], sc.cv_results['step_counter']['y_pred'])
+        assert models.StepCounter.load(os.path.join(tmpdir, 'rf')).cv_results is None
+
+        # SSL
+        sc = models.StepCounter(wd_type='ssl')
+        X, _, groups = make_training_windows(n=300, window_len=sc.window_len, sample_rate=sc.sample_rate)
+        net = sslmodel.get_sslnet(tag=sc.wd.repo_tag, pretrained=False)
+        sc.wd.state_dict = net.state_dict()
+        rng = np.random.default_rng(0)
+        sc.wd.hmms.fit(rng.integers(2, size=len(X)), rng.integers(2, size=len(X)), groups=groups)
+        sc.find_peaks_params = {'distance': .5, 'prominence': .5}
+        loaded = check_round_trip('ssl', sc, X, groups, tmpdir)
+        assert loaded.wd.state_dict.keys() == sc.wd.state_dict.keys()
+        assert all(torch.equal(loaded.wd.state_dict[k], v) for k, v in sc.wd.state_dict.items())
+
+        # an unfitted SSL detector fails, rather than predicting with the weights
+        # the shared network last held (those of the detector above)
+        try:
+            models.WalkDetectorSSL().predict(X, groups)
+        except ValueError:
+            print("unfitted WalkDetectorSSL: ValueError")
+        else:
+            raise AssertionError("unfitted WalkDetectorSSL predicted")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+""" Benchmark stepcount.models.toV against the original version, and check
+that its default output is bit-identical (float32 mode within 1e-4).
+
+    python benchmarks/bench_toV.py [n_windows]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import scipy.signal as signal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+from stepcount import models  # noqa: E402
+
+
+def butterfilt_reference(x, cutoffs, fs, order=4, axis=0):
+    """ Original butterfilt: the filter is designed on every call """
+    nyq = 0.5 * fs
+    if isinstance(cutoffs, tuple):
+        hicut, lowcut = cutoffs
+        if hicut > 0:
+            btype = 'bandpass'
+            Wn = (hicut / nyq, lowcut / nyq)
+        else:
+            btype = 'low'
+            Wn = lowcut / nyq
+    else:
+        btype = 'low'
+        Wn = cutoffs / nyq
+    sos = signal.butter(order, Wn, btype=btype, analog=False, output='sos')
+    y = signal.sosfiltfilt(sos, x, axis=axis)
+    return y
+
+
+def toV_reference(x, sample_rate, lowpass_hz):
+    """ Original toV: whole array at once """
+    V = np.linalg.norm(x, axis=-1)
+    V = V - 1
+    V = np.clip(V, -2, 2)
+    V = butterfilt_reference(V, lowpass_hz, sample_rate, axis=-1)
+    return V
+
+
+def measure(fn):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fn()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, elapsed, peak / 2**20
+
+
+def main(n=20_000, sample_rate=100, lowpass_hz=5, seed=0):
+    n = int(n)
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, 500, 3)) + [0, 0, 1]
+
+    expected, t_ref, mem_ref = measure(lambda: toV_reference(X, sample_rate, lowpass_hz))
+    print(f"{n} windows: reference {t_ref:.2f}s, peak {mem_ref:.0f}MB")
+
+    V, t_new, mem_new = measure(lambda: models.toV(X, sample_rate, lowpass_hz))
+    assert np.array_equal(V, expected)
+    print(f"{n} windows: toV {t_new:.2f}s, peak {mem_new:.0f}MB, bit-identical")
+
+    V, t_new, mem_new = measure(lambda: models.toV(X, sample_rate, lowpass_hz, dtype='float32'))
+    err = np.max(np.abs(V - expected))
+    assert err < 1e-4
+    print(f"{n} windows: toV(dtype='float32') {t_new:.2f}s, peak {mem_new:.0f}MB, max abs difference {err:.1e}")
+
+    # single window
+    assert np.array_equal(models.toV(X[0], sample_rate, lowpass_hz), toV_reference(X[0], sample_rate, lowpass_hz))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,155 @@
+""" Benchmark the Viterbi decoders (utils.viterbi, stepcount.hmm_utils.viterbi
+and its numba kernel) against the original per-label loop, and check that
+they all decode the same paths.
+
+    python benchmarks/bench_viterbi.py [n_cases]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '8_stepcount'))
+import utils  # noqa: E402
+from stepcount import hmm_utils, kernels  # noqa: E402
+
+
+def viterbi_reference(Y, hmm_params):
+    """ Original implementation: one max per label per step, backward pass
+    recomputed from the scores """
+
+    def log(x):
+        SMALL_NUMBER = 1e-16
+        return np.log(x + SMALL_NUMBER)
+
+    prior = hmm_params['prior']
+    emission = hmm_params['emission']
+    transition = hmm_params['transition']
+    labels = hmm_params['labels']
+
+    nobs = len(Y)
+    nlabels = len(labels)
+
+    Y = np.where(Y.reshape(-1, 1) == labels)[1]  # to numeric
+
+    probs = np.zeros((nobs, nlabels))
+    probs[0, :] = log(prior) + log(emission[:, Y[0]])
+    for j in range(1, nobs):
+        for i in range(nlabels):
+            probs[j, i] = np.max(
+                log(emission[i, Y[j]]) +
+                log(transition[:, i]) +
+                probs[j - 1, :])  # probs already in log scale
+    viterbi_path = np.zeros_like(Y)
+    viterbi_path[-1] = np.argmax(probs[-1, :])
+    for j in reversed(range(nobs - 1)):
+        viterbi_path[j] = np.argmax(
+            log(transition[:, viterbi_path[j + 1]]) +
+            probs[j, :])  # probs already in log scale
+
+    viterbi_path = labels[viterbi_path]  # to labels
+
+    return viterbi_path
+
+
+def viterbi_reference_groups(Y, hmm_params, groups):
+    """ Original HMMSmoother.viterbi: one decode per group """
+    return np.concatenate([
+        viterbi_reference(Y[groups == g], hmm_params)
+        for g in hmm_utils.ordered_unique(groups)
+    ])
+
+
+def random_params(rng, labels, kind='random'):
+    nlabels = len(labels)
+    if kind == 'uniform':
+        prior = np.full(nlabels, 1 / nlabels)
+        emission = np.full((nlabels, nlabels), 1 / nlabels)
+        transition = np.full((nlabels, nlabels), 1 / nlabels)
+    elif kind == 'identity':
+        prior = np.full(nlabels, 1 / nlabels)
+        emission = np.eye(nlabels)
+        transition = np.eye(nlabels)
+    else:
+        prior = rng.dirichlet(np.ones(nlabels))
+        emission = rng.dirichlet(np.ones(nlabels), size=nlabels)
+        transition = rng.dirichlet(np.ones(nlabels), size=nlabels)
+    return {'prior': prior, 'emission': emission, 'transition': transition, 'labels': labels}
+
+
+def random_case(rng, kind):
+    labels = np.arange(rng.integers(2, 6))
+    if rng.random() < .5:
+        labels = np.array(['sleep', 'sit-stand', 'walking', 'vehicle', 'mixed'])[labels]
+    params = random_params(rng, labels, kind)
+    nobs = rng.integers(1, 300)
+    Y = labels[rng.integers(len(labels), size=nobs)]
+    groups = np.sort(rng.integers(rng.integers(1, 6), size=nobs))
+    return Y, params, groups
+
+
+def decoders():
+    yield 'utils.viterbi', lambda Y, params, groups: np.concatenate([
+        utils.viterbi(Y[groups == g], params) for g in hmm_utils.ordered_unique(groups)
+    ])
+    has_numba = kernels.HAS_NUMBA
+    kernels.HAS_NUMBA = False
+    yield 'hmm_utils.viterbi', lambda Y, params, groups: hmm_utils.viterbi(Y, params, groups)
+    kernels.HAS_NUMBA = has_numba
+    if has_numba:
+        yield 'hmm_utils.viterbi (numba)', lambda Y, params, groups: hmm_utils.viterbi(Y, params, groups)
+
+
+def check(n_cases=200, seed=0):
+    rng = np.random.default_rng(seed)
+    cases = [random_case(rng, ('random', 'uniform', 'identity')[i % 3]) for i in range(n_cases)]
+    for name, decode in decoders():
+        for Y, params, groups in cases:
+            expected = viterbi_reference_groups(Y, params, groups)
+            assert np.array_equal(decode(Y, params, groups), expected), name
+        print(f"{name}: identical paths on {n_cases} random cases")
+
+
+def bench(seed=0):
+    rng = np.random.default_rng(seed)
+    labels = np.array([0, 1])
+    params = random_params(rng, labels)
+
+    # one long sequence
+    Y = labels[rng.integers(2, size=20_000)]
+    groups = np.zeros(len(Y), dtype='int')
+    t0 = time.perf_counter()
+    viterbi_reference(Y, params)
+    print(f"20k observations: reference {time.perf_counter() - t0:.2f}s")
+    for name, decode in decoders():
+        t0 = time.perf_counter()
+        decode(Y, params, groups)
+        print(f"20k observations: {name} {time.perf_counter() - t0:.2f}s")
+
+    # many groups, e.g. 150 participants of one day of 30s windows
+    Y = labels[rng.integers(2, size=150 * 2880)]
+    groups = np.repeat(np.arange(150), 2880)
+    t0 = time.perf_counter()
+    viterbi_reference_groups(Y, params, groups)
+    print(f"150 groups x 2880: reference {time.perf_counter() - t0:.2f}s")
+    for name, decode in decoders():
+        t0 = time.perf_counter()
+        decode(Y, params, groups)
+        print(f"150 groups x 2880: {name} {time.perf_counter() - t0:.2f}s")
+
+    # one long group and many short ones: decoded in batches of similar
+    # lengths rather than all padded to the longest
+    Y = labels[rng.integers(2, size=20_000 + 2000 * 10)]
+    groups = np.r_[np.zeros(20_000, dtype='int'), np.repeat(np.arange(1, 2001), 10)]
+    expected = viterbi_reference_groups(Y, params, groups)
+    for name, decode in decoders():
+        t0 = time.perf_counter()
+        assert np.array_equal(decode(Y, params, groups), expected), name
+        print(f"20k + 2000 groups x 10: {name} {time.perf_counter() - t0:.2f}s, identical")
+
+
+if __name__ == '__main__':
+    check(*map(int, sys.argv[1:]))
+    bench()
@@ -28,8 +28,6 @@ from sklearn import decomposition
 from sklearn import preprocessing
 from sklearn import manifold
 from sklearn import metrics
-from tqdm.auto import tqdm
-from joblib import Parallel, delayed
 
 import utils
 
@@ -273,40 +271,19 @@ participant P002 didn't have the "vehicle" class.
 
 ### Next steps
 So far we've only trained on one subject. To use the whole dataset, repeat the
-data processing for each of the subjects and concatenate them. You can use the
-code below for this.
+data processing for each of the subjects and concatenate them. You can use
+`utils.build_dataset` for this, as in the code below.
 
 '''
 
 #%%
 
-def load_all_and_make_windows(datafiles):
-
-    def worker(datafile):
-        X, Y, T = utils.make_windows(utils.load_data(datafile), winsec=30)
-        pid = os.path.basename(datafile).split(".")[0]  # participant ID
-        pid = np.asarray([pid] * len(X))
-        return X, Y, T, pid
-
-    results = Parallel(n_jobs=4)(
-        delayed(worker)(datafile) for datafile in tqdm(datafiles))
-
-    X = np.concatenate([result[0] for result in results])
-    Y = np.concatenate([result[1] for result in results])
-    T = np.concatenate([result[2] for result in results])
-    pid = np.concatenate([result[3] for result in results])
-
-    return X, Y, T, pid
-
 # # Uncomment below to process all files
 # DATAFILES = CAPTURE24_PATH+'P[0-9][0-9][0-9].csv.gz'
-# X, Y, T, pid = load_all_and_make_windows(glob(DATAFILES))
-# # Save arrays for future use
-# os.makedirs("processed_data/", exist_ok=True)
-# np.save("processed_data/X.npy", X)
-# np.save("processed_data/Y.npy", Y)
-# np.save("processed_data/T.npy", T)
-# np.save("processed_data/pid.npy", pid)
+# # Each participant is saved to processed_data/shards/ as it is processed,
+# # then all are merged into processed_data/X.npy, Y.npy, T.npy and pid.npy.
+# # If interrupted, re-running resumes from the participants already done.
+# utils.build_dataset(sorted(glob(DATAFILES)), "processed_data/", winsec=30, n_jobs=4)
 
 # %% [markdown]
 '''
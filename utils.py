@@ -1,6 +1,10 @@
+import os
+import json
+import hashlib
 import warnings
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from tqdm.auto import tqdm
 
 import matplotlib.pyplot as plt
@@ -8,47 +12,326 @@ import matplotlib as mpl
 import matplotlib.patches as mpatches
 
 
-def load_data(datafile):
-    """ Utility function to load the data files with correct dtypes """
-    data = pd.read_csv(
+# suggested location for load_data(..., cache_dir=CACHE_DIR)
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rmlhds')
+
+
+def load_data(datafile, cache_dir=None):
+    """ Utility function to load the data files with correct dtypes
+
+    If `cache_dir` is given (e.g. `utils.CACHE_DIR`), parsed files are cached
+    there as .npy arrays (keyed by the file's path, mtime and size) so that
+    subsequent loads memory-map them instead of parsing the CSV again. The
+    cache is uncompressed and never pruned: about 180MB per 24h recording at
+    100Hz, or ~27GB for the whole of Capture-24. Only used when `datafile` is
+    a path; file-like objects are always parsed.
+    """
+
+    if not isinstance(datafile, (str, os.PathLike)):
+        cache_dir = None
+
+    if cache_dir is not None:
+        data = _load_cached_data(datafile, cache_dir)
+        if data is not None:
+            return data
+
+    data = _read_csv(datafile)
+
+    if cache_dir is not None:
+        try:
+            _save_cached_data(data, datafile, cache_dir)
+        except OSError as e:
+            warnings.warn(f"Could not cache {datafile}: {e}")
+
+    return data
+
+
+def _read_csv(datafile, **kwargs):
+    return pd.read_csv(
         datafile,
         index_col='time', parse_dates=['time'],
-        dtype={'x': 'f4', 'y': 'f4', 'z': 'f4', 'annotation': 'string'}
+        dtype={'x': 'f4', 'y': 'f4', 'z': 'f4', 'annotation': 'string'},
+        **kwargs
     )
+
+
+def _cache_path(datafile, cache_dir):
+    datafile = os.path.abspath(datafile)
+    name = os.path.basename(datafile).split(".")[0]
+    key = hashlib.md5(datafile.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{name}-{key}")
+
+
+def _cache_key(datafile):
+    stat = os.stat(datafile)
+    return {
+        'path': os.path.abspath(datafile),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+    }
+
+
+def _load_cached_data(datafile, cache_dir):
+    """ Load from cache, or return None if missing or stale """
+
+    path = _cache_path(datafile, cache_dir)
+
+    try:
+        with open(os.path.join(path, 'key.json')) as f:
+            key = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if key != _cache_key(datafile):
+        return None
+
+    # copy-on-write memmaps: writable frames without modifying the cache
+    xyz = np.load(os.path.join(path, 'xyz.npy'), mmap_mode='c')
+    time = np.load(os.path.join(path, 'time.npy'), mmap_mode='c')
+    codes = np.load(os.path.join(path, 'annotation_codes.npy'), mmap_mode='c')
+    categories = np.load(os.path.join(path, 'annotation_categories.npy'))
+
+    data = pd.DataFrame(
+        xyz, columns=['x', 'y', 'z'],
+        index=pd.DatetimeIndex(time, name='time'),
+        copy=False,
+    )
+    data['annotation'] = pd.array(categories, dtype='string').take(codes, allow_fill=True)
+
     return data
 
 
-def make_windows(data, winsec=30, sample_rate=100, dropna=True, verbose=False):
+def _save_cached_data(data, datafile, cache_dir):
+
+    path = _cache_path(datafile, cache_dir)
+    os.makedirs(path, exist_ok=True)
+
+    # invalidate first, the key is written last once all arrays are in place
+    keyfile = os.path.join(path, 'key.json')
+    if os.path.exists(keyfile):
+        os.remove(keyfile)
+
+    codes, categories = pd.factorize(data['annotation'])
+    codes = codes.astype(np.min_scalar_type(-len(categories) - 1))
+
+    arrays = {
+        'xyz': data[['x', 'y', 'z']].to_numpy(),
+        'time': data.index.to_numpy(),
+        'annotation_codes': codes,
+        'annotation_categories': np.asarray(categories, dtype='str'),
+    }
+
+    # write to a temp file and replace: frames from earlier loads may still
+    # memory-map the old files, which must not be modified or truncated
+    for name, arr in arrays.items():
+        tmpfile = os.path.join(path, f"{name}.tmp{os.getpid()}.npy")
+        np.save(tmpfile, arr)
+        os.replace(tmpfile, os.path.join(path, f"{name}.npy"))
+
+    tmpfile = f"{keyfile}.tmp{os.getpid()}"
+    with open(tmpfile, 'w') as f:
+        json.dump(_cache_key(datafile), f)
+    os.replace(tmpfile, keyfile)
+
 
-    X, Y, T = [], [], []
+def make_windows(data, winsec=30, sample_rate=100, dropna=True, verbose=False, origin='start'):
+    """ Split data into windows of `winsec` seconds, starting at `origin`
+    (the first timestamp by default, as in data.resample).
 
-    for t, w in tqdm(data.resample(f"{winsec}s", origin='start'), disable=not verbose):
+    Returns arrays X (n, winsec*sample_rate, 3), Y (n,) and T (n,) with the
+    window signals, their most frequent annotation and their start times.
+    Windows with NaNs or incomplete length are dropped, as well as windows
+    with no annotation (if dropna). Windows are built in bulk with strided
+    views over the underlying arrays rather than resampling group by group.
+    `verbose` is ignored (there is no longer a per-window loop to report on),
+    it is kept for backward compatibility.
+    """
 
-        if len(w) < 1:
-            continue
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index(kind='mergesort')
+
+    t = data.index.to_numpy()
+    xyz = np.ascontiguousarray(data[['x', 'y', 'z']].to_numpy())
+
+    if len(t) < 1:
+        return _empty_windows(xyz, t, winsec, sample_rate)
+
+    if isinstance(origin, str) and origin == 'start':
+        origin = t[0]
+    else:
+        origin = pd.Timestamp(origin).to_datetime64()
+
+    # window id of each sample, same binning as data.resample(origin=origin)
+    winlen = pd.Timedelta(seconds=winsec).to_timedelta64()
+    wid = (t - origin) // winlen
+
+    # boundaries of the (non-empty) windows
+    starts = np.flatnonzero(np.r_[True, wid[1:] != wid[:-1]])
+    ends = np.r_[starts[1:], len(t)]
+    lens = ends - starts
+    T = (origin + wid[starts] * winlen).astype(t.dtype)
+
+    # window labels: most frequent annotation code per window, ties resolved
+    # to the smallest code as in Series.mode (categories sorted, NA last)
+    codes, uniques = pd.factorize(data['annotation'], sort=True)
+    ncodes = len(uniques) + 1
+    codes = np.where(codes < 0, ncodes - 1, codes)
+    wpos = np.repeat(np.arange(len(starts)), lens)
+    counts = np.bincount(wpos * ncodes + codes, minlength=len(starts) * ncodes)
+    Ycodes = counts.reshape(-1, ncodes).argmax(axis=1)
+
+    # validity masks: annotation, window length, nans
+    ok = lens == sample_rate * winsec
+    if dropna:
+        ok &= Ycodes != ncodes - 1
+    nancount = np.r_[0, np.cumsum(np.isnan(xyz).any(axis=1))]
+    ok &= (nancount[ends] - nancount[starts]) == 0
+
+    if not ok.any():
+        return _empty_windows(xyz, t, winsec, sample_rate)
+
+    starts, Ycodes, T = starts[ok], Ycodes[ok], T[ok]
+
+    window_len = int(sample_rate * winsec)
+    views = np.lib.stride_tricks.as_strided(
+        xyz,
+        shape=(len(xyz) - window_len + 1, window_len, xyz.shape[1]),
+        strides=(xyz.strides[0], xyz.strides[0], xyz.strides[1]),
+        writeable=False,
+    )
+    X = views[starts]
+
+    labels = np.asarray(list(uniques) + [pd.NA], dtype='object')
+    Y = np.asarray(labels[Ycodes].tolist())
+
+    return X, Y, T
 
-        t = t.to_numpy()
 
-        x = w[['x', 'y', 'z']].to_numpy()
+def iter_windows(datafile, winsec=30, sample_rate=100, dropna=True, chunksize=1_000_000):
+    """ Like make_windows(load_data(datafile)), but reading the file in chunks
+    of `chunksize` rows and yielding (X, Y, T) batches as they complete.
+    Rows of a window straddling two chunks are carried over to the next one,
+    so the concatenated batches are the same as the windows of the whole
+    file, while memory is bounded by the chunk size.
+    """
 
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", message="Unable to sort modes")
-            y = w['annotation'].mode(dropna=False).iloc[0]
+    winlen = pd.Timedelta(seconds=winsec)
+    origin = None
+    carry = None
 
-        if dropna and pd.isna(y):  # skip if annotation is NA
-            continue
+    for chunk in _read_csv(datafile, chunksize=chunksize):
 
-        if not is_good_window(x, sample_rate, winsec):  # skip if bad window
-            continue
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
 
-        X.append(x)
-        Y.append(y)
-        T.append(t)
+        if origin is None:
+            origin = chunk.index[0]
 
-    X = np.stack(X)
-    Y = np.stack(Y)
-    T = np.stack(T)
+        # the last window may continue in the next chunk, hold it back
+        last_start = origin + ((chunk.index[-1] - origin) // winlen) * winlen
+        i = chunk.index.searchsorted(last_start)
+        chunk, carry = chunk.iloc[:i], chunk.iloc[i:]
 
+        if len(chunk) > 0:
+            X, Y, T = make_windows(chunk, winsec, sample_rate, dropna, origin=origin)
+            if len(X) > 0:
+                yield X, Y, T
+
+    if carry is not None and len(carry) > 0:
+        X, Y, T = make_windows(carry, winsec, sample_rate, dropna, origin=origin)
+        if len(X) > 0:
+            yield X, Y, T
+
+
+def build_dataset(datafiles, outdir='processed_data/', winsec=30, sample_rate=100, n_jobs=4, verbose=True):
+    """ Process all participant files into X.npy, Y.npy, T.npy and pid.npy in `outdir`.
+
+    Each participant's windows are first saved to their own shard in
+    outdir/shards/<winsec>s-<sample_rate>hz/ by the parallel workers. The shards are then copied one at
+    a time into the final arrays, preallocated with np.lib.format.open_memmap,
+    so memory in the parent process does not grow with the number of
+    participants. Existing shards built with the same windowing parameters
+    are reused: if the build is interrupted, calling this again resumes it.
+    A manifest.csv lists the windows range of each participant in the final
+    arrays.
+    """
+
+    if len(datafiles) == 0:
+        raise ValueError("No datafiles given")
+
+    shard_dir = os.path.join(outdir, 'shards', f"{winsec}s-{sample_rate}hz")
+    os.makedirs(shard_dir, exist_ok=True)
+
+    shards = Parallel(n_jobs=n_jobs)(
+        delayed(_build_shard)(datafile, shard_dir, winsec, sample_rate)
+        for datafile in tqdm(datafiles, disable=not verbose)
+    )
+
+    arrs = {
+        name: [np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for _, path in shards]
+        for name in ('X', 'Y', 'T')
+    }
+    lens = np.asarray([len(x) for x in arrs['X']], dtype='int')
+    starts = np.r_[0, np.cumsum(lens)[:-1]].astype('int')
+    total = int(lens.sum())
+    pids = [pid for pid, _ in shards]
+
+    out = {
+        name: np.lib.format.open_memmap(
+            os.path.join(outdir, f"{name}.npy"), mode='w+',
+            dtype=np.result_type(*[a.dtype for a in arrs[name]]),
+            shape=(total,) + arrs[name][0].shape[1:],
+        )
+        for name in ('X', 'Y', 'T')
+    }
+    out['pid'] = np.lib.format.open_memmap(
+        os.path.join(outdir, 'pid.npy'), mode='w+',
+        dtype=np.asarray(pids).dtype, shape=(total,),
+    )
+
+    for i in tqdm(range(len(shards)), disable=not verbose):
+        for name in ('X', 'Y', 'T'):
+            out[name][starts[i]:starts[i] + lens[i]] = arrs[name][i]
+        out['pid'][starts[i]:starts[i] + lens[i]] = pids[i]
+
+    for arr in out.values():
+        arr.flush()
+
+    manifest = pd.DataFrame({
+        'pid': pids,
+        'start': starts,
+        'n': lens,
+        'datafile': [os.path.abspath(f) for f in datafiles],
+        'shard': [path for _, path in shards],
+    })
+    manifest.to_csv(os.path.join(outdir, 'manifest.csv'), index=False)
+
+    return manifest
+
+
+def _build_shard(datafile, shard_dir, winsec, sample_rate):
+    """ Save the windows of one participant, unless already done """
+
+    pid = os.path.basename(datafile).split(".")[0]  # participant ID
+    path = os.path.join(shard_dir, pid)
+
+    if not os.path.exists(path):
+        X, Y, T = make_windows(load_data(datafile), winsec, sample_rate)
+        # write to a temp dir first so that incomplete shards are never reused
+        tmp = path + '.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, 'X.npy'), X)
+        np.save(os.path.join(tmp, 'Y.npy'), Y)
+        np.save(os.path.join(tmp, 'T.npy'), T)
+        os.replace(tmp, path)
+
+    return pid, path
+
+
+def _empty_windows(xyz, t, winsec, sample_rate):
+    X = np.empty((0, int(sample_rate * winsec), 3), dtype=xyz.dtype)
+    Y = np.empty(0, dtype='str')
+    T = np.empty(0, dtype=t.dtype)
     return X, Y, T
 
 
@@ -174,20 +457,23 @@ def viterbi(Y_obs, hmm_params):
 
     Y_obs = np.where(Y_obs.reshape(-1,1)==labels)[1]  # to numeric
 
+    # precompute log-parameters
+    log_prior = log(prior)
+    log_emission = log(emission)[:, Y_obs].T  # (nobs, nlabels)
+    log_transition = log(transition)  # (from, to)
+
     probs = np.zeros((nobs, nlabels))
-    probs[0,:] = log(prior) + log(emission[:, Y_obs[0]])
+    backpointers = np.zeros((nobs, nlabels), dtype='int')
+    probs[0,:] = log_prior + log_emission[0]
+    states = np.arange(nlabels)
     for j in range(1, nobs):
-        for i in range(nlabels):
-            probs[j,i] = np.max(
-                log(emission[i, Y_obs[j]]) + \
-                log(transition[:, i]) + \
-                probs[j-1,:])  # probs already in log scale
+        scores = log_transition + probs[j-1,:,None]  # probs already in log scale
+        backpointers[j,:] = np.argmax(scores, axis=0)
+        probs[j,:] = log_emission[j] + scores[backpointers[j], states]
     viterbi_path = np.zeros_like(Y_obs)
     viterbi_path[-1] = np.argmax(probs[-1,:])
     for j in reversed(range(nobs-1)):
-        viterbi_path[j] = np.argmax(
-            log(transition[:, viterbi_path[j+1]]) + \
-            probs[j,:])  # probs already in log scale
+        viterbi_path[j] = backpointers[j+1, viterbi_path[j+1]]
 
     viterbi_path = labels[viterbi_path]  # to labels
 